@@ -38,13 +38,20 @@
 
 import datetime as dt
 import pandas as pd
+from crm_data import load_online_retail
+from crm_preprocessing import clean_transactions
+from crm_rfm import SegmentMap, compute_customer_aggregates_parallel, pack_scores
 
 pd.set_option('display.max_columns', None)
 # pd.set_option('display.max_rows',None) is not necessary as the rows will be crowded
 pd.set_option('display.float_format', lambda x: '%.3f' % x) # How many digits after the comma of the numeric digit?
 
-df_ = pd.read_excel(r"C:\Users\Baris\PycharmProjects\PythonProject2022\Crm_Analysis\datasets\online_retail_II.xlsx",
-                     sheet_name="Year 2009-2010")
+DATA_PATH = r"C:\Users\Baris\PycharmProjects\PythonProject2022\Crm_Analysis\datasets\online_retail_II.xlsx"
+df_ = load_online_retail(DATA_PATH, sheet_name="Year 2009-2010")
+# For a two-year analysis both sheets can be loaded into one frame (from crm_data import load_transactions):
+# df_ = load_transactions([(DATA_PATH, "Year 2009-2010"), (DATA_PATH, "Year 2010-2011")])
+# On Windows the sheets are read one after another; max_workers=2 reads them in parallel worker processes,
+# which re-run this script unless it is under if __name__ == "__main__":.
 df = df_.copy()
 df.head()
 df.shape
@@ -86,10 +93,10 @@ df.shape
 df.describe().T
 
 # We need to remove returned invoices from the data set
-df[~df["Invoice"].str.contains("C", na=False)]
+df[~df["is_cancelled"]]
 
 # If we wanted to choose...
-df = df[df["Invoice"].str.contains("C", na=False)]
+df = df[df["is_cancelled"]]
 
 ####################### ##############
 # 4. Calculating RFM Metrics
@@ -107,6 +114,10 @@ df["InvoiceDate"].max()
 today_date = dt.datetime(2010, 12, 11)
 type(today_date)
 
+# With the month-partitioned store of crm_store.py a rolling or backdated run only reads the months of its window:
+# write_transaction_store(df_, STORE_DIR)   # once, then append new batches
+# df = read_transaction_store(STORE_DIR, start=today_date - dt.timedelta(days=365), end=today_date)
+
 # For calculation based on all customers.
 rfm = df.groupby('Customer ID').agg({'InvoiceDate': lambda InvoiceDate: (today_date - InvoiceDate.max()).days,
                                       'Invoice': lambda Invoice: Invoice.nunique(),
@@ -140,16 +151,16 @@ rfm["monetary_score"] = pd.qcut(rfm["monetary"], 5, labels=[1, 2, 3, 4, 5, ])
 rfm["frequency_score"] = pd.cut(rfm["frequency"].rank(method="first"), 5, labels=[1, 2, 3, 4, 5])
 
 # We need to create a score variable based on these values. R AND F must be together. We calculated the M value to observe it.
-rfm["RFM_SCORE"] = (rfm["recency_score"].astype(str) +
-                     rfm["frequency_score"].astype(str))
+# The score is packed into one integer (recency 5, frequency 4 -> 54) instead of concatenating strings.
+rfm["RFM_SCORE"] = pack_scores(rfm["recency_score"], rfm["frequency_score"])
 
 rfm.describe().T
 
 # Who are our champion customers
-rfm[rfm["RFM_SCORE"] == "55"]
+rfm[rfm["RFM_SCORE"] == 55]
 
 # For less valuable customers
-rfm[rfm["RFM_SCORE"] == "11"]
+rfm[rfm["RFM_SCORE"] == 11]
 
 ####################### ##############
 # 6. Creating & Analyzing RFM Segments
@@ -172,8 +183,9 @@ seg_map = {
 }
 
 # Code that will allow us to capture the structure and capture two values
+# SegmentMap runs the seg_map regexes once on all 25 score pairs and then assigns segments by table lookup.
 
-rfm['segment'] = rfm['RFM_SCORE'].replace(seg_map, regex=True)
+rfm['segment'] = SegmentMap(seg_map).assign(rfm["recency_score"], rfm["frequency_score"])
 
 # It is necessary to analyze the created segments.
 
@@ -213,31 +225,46 @@ rfm.to_csv("rfm.csv")
 df= df_.copy()
 rfm_new = create_rfm(df, csv=True)
 
-def create_rfm(dataframe, csv=False):
-
-     # PREPARING THE DATA
-     dataframe["TotalPrice"] = dataframe["Quantity"] * dataframe["Price"]
-     dataframe.dropna(inplace=True)
-     dataframe = dataframe[~dataframe["Invoice"].str.contains("C", na=False)]
-
-     # CALCULATION OF RFM METRICS
-     today_date = dt.datetime(2011, 12, 11)
-     rfm = dataframe.groupby('Customer ID').agg({'InvoiceDate': lambda date: (today_date - date.max()).days,
-                                                 'Invoice': lambda num: num.nunique(),
-                                                 "TotalPrice": lambda price: price.sum()})
-     rfm.columns = ['recency', 'frequency', "monetary"]
-     rfm = rfm[(rfm['monetary'] > 0)]
-
-     # CALCULATION OF RFM SCORES
-     rfm["recency_score"] = pd.qcut(rfm['recency'], 5, labels=[5, 4, 3, 2, 1])
-     rfm["frequency_score"] = pd.qcut(rfm["frequency"].rank(method="first"), 5, labels=[1, 2, 3, 4, 5])
-     rfm["monetary_score"] = pd.qcut(rfm['monetary'], 5, labels=[1, 2, 3, 4, 5])
-
-     # cltv_df scores were converted to categorical values and added to df
-     rfm["RFM_SCORE"] = (rfm['recency_score'].astype(str) +
-                         rfm['frequency_score'].astype(str))
-
-     # NAMING THE SEGMENTS
+# In production only one day of new invoices arrives at a time. RFMState (crm_rfm.py) keeps the per-customer
+# metrics and absorbs each daily batch, giving the same recency / frequency / monetary as create_rfm:
+# rfm_state = RFMState.load("rfm_state")
+# rfm_state.update(todays_invoices).save("rfm_state")
+# rfm_state.rfm_metrics(today_date)
+
+# For archives larger than memory, create_rfm_out_of_core (crm_rfm.py) reads the transactions in chunks:
+# rfm_new = create_rfm_out_of_core(r"...\transactions.csv", dt.datetime(2011, 12, 11), chunksize=500_000)
+
+# Monthly snapshots to follow the segments over time, all from one pass over the transactions (crm_rfm.py):
+# snapshots = create_rfm_snapshots(clean_transactions(df, rules=("missing", "cancelled")),
+#                                  pd.date_range("2011-01-01", "2011-12-01", freq="MS"))
+# snapshots.groupby(["date", "segment"], observed=True).size().unstack()
+# Stored as integer segment codes (crm_store.py), the snapshots give the monthly segment migrations:
+# write_segment_snapshots(snapshots, "rfm_snapshots")
+# transitions = segment_transitions(read_segment_snapshots("rfm_snapshots"))
+# migration_matrix(transitions, normalize=True)   # e.g. share of champions that became at_Risk
+
+def create_rfm(dataframe, csv=False, n_jobs=1):
+
+    # PREPARING THE DATA
+    dataframe = clean_transactions(dataframe, rules=("missing", "cancelled"))
+
+    # CALCULATION OF RFM METRICS
+    today_date = dt.datetime(2011, 12, 11)
+    # n_jobs > 1 (or None for all cores) aggregates customer-id shards in parallel, the result is the same
+    # (only on large tables and multi-core machines, and the calling script needs if __name__ == "__main__":)
+    rfm = compute_customer_aggregates_parallel(dataframe, today_date, n_jobs=n_jobs,
+                                               invoice_col="InvoiceNo")[['recency', 'frequency', 'monetary']]
+    rfm = rfm[(rfm['monetary'] > 0)]
+
+    # CALCULATION OF RFM SCORES
+    rfm["recency_score"] = pd.qcut(rfm['recency'], 5, labels=[5, 4, 3, 2, 1]).astype("uint8")
+    rfm["frequency_score"] = pd.qcut(rfm["frequency"].rank(method="first"), 5, labels=[1, 2, 3, 4, 5]).astype("uint8")
+    rfm["monetary_score"] = pd.qcut(rfm['monetary'], 5, labels=[1, 2, 3, 4, 5]).astype("uint8")
+
+    # the scores are packed into one integer code (54 = recency 5, frequency 4)
+    rfm["RFM_SCORE"] = pack_scores(rfm['recency_score'], rfm['frequency_score'])
+
+    # NAMING THE SEGMENTS
     seg_map = {
         r'[1-2][1-2]': 'hibernating',
         r'[1-2][3-4]': 'at_risk',
@@ -251,7 +278,7 @@ def create_rfm(dataframe, csv=False):
         r'5[4-5]': 'champions'
     }
 
-    rfm['segment'] = rfm['RFM_SCORE'].replace(seg_map, regex=True)
+    rfm['segment'] = SegmentMap(seg_map).assign(rfm["recency_score"], rfm["frequency_score"])
     rfm = rfm[["recency", "frequency", "monetary", "segment"]]
     rfm.index = rfm.index.astype(int)
 
@@ -58,6 +58,10 @@
 # !pip install lifetimes
 import datetime as dt
 import pandas as pd
+from crm_data import load_online_retail
+from crm_preprocessing import Winsorizer, clean_transactions
+from crm_rfm import compute_customer_aggregates_parallel
+from crm_cltv import BetaGeoModel, GammaGammaModel, ModelCache
 import matplotlib.pyplot as plt
 from lifetimes import BetaGeoFitter
 from lifetimes import GammaGammaFitter
@@ -94,8 +98,8 @@ def replace_with_thresholds(dataframe, variable):
 #############################
 # Reading Data
 #############################
-df_ = pd.read_excel(r"C:\Users\Baris\PycharmProjects\PythonProject2022\Crm_Analysis\datasets\online_retail_II.xlsx",
-                     sheet_name="Year 2010-2011")
+df_ = load_online_retail(r"C:\Users\Baris\PycharmProjects\PythonProject2022\Crm_Analysis\datasets\online_retail_II.xlsx",
+                         sheet_name="Year 2010-2011")
 df = df_.copy()
 df.describe().T
 df.head()
@@ -105,17 +109,12 @@ df.isnull().sum()
 # Data Preprocessing
 #############################
 
-df.dropna(inplace=True)
-df = df[~df["Invoice"].str.contains("C", na=False)]
-df = df[df["Price"] > 0]
-df = df[df["Quantity"] > 0]
-
-# We called a function to suppress outliers.
-replace_with_thresholds(df, "Quantity")
-replace_with_thresholds(df, "Price")
-
-# We will create the Total price variable. The total price paid for a product.
-df["TotalPrice"] = df["Quantity"] * df["Price"]
+# Missing values, cancelled invoices, Price<=0 and Quantity<=0 are removed with one combined mask.
+# Outliers are suppressed on the upper side like replace_with_thresholds above (Winsorizer(clip_lower=False)),
+# and the Total price variable (the total price paid for a product) is added.
+# The report shows how many rows each rule removed and the peak memory of the step.
+df, cleaning_report = clean_transactions(df, winsorizer=Winsorizer(clip_lower=False), report=True)
+cleaning_report
 
 today_date = dt.datetime(2011, 12, 11)
 
@@ -308,67 +307,83 @@ cltv_final.groupby("Segment").agg(
 #6. Functionalization of Work
 ####################### #############
 
-def create_cltv_p(dataframe, month=3):
+# For a nightly refit the models of the previous night can be loaded and used as the starting point:
+# bgf = BetaGeoModel(penalizer_coef=0.001).fit(..., warm_start=BetaGeoModel.load("bgnbd.json"))
+# bgf.save("bgnbd.json"); bgf.diagnostics_   # warm / cold start, iterations, gradient norm
+# Repeated calls on the same data (e.g. month=1, 3, 6 or another n_segments) can share one cache folder:
+# create_cltv_p(df, month=6, cache_dir="datasets/.cltv_cache")
+
+def create_cltv_p(dataframe, month=3, n_jobs=1, n_segments=4, cache_dir=None):
      #one. Data Preprocessing
-     dataframe.dropna(inplace=True)
-     dataframe = dataframe[~dataframe["Invoice"].str.contains("C", na=False)]
-     dataframe = dataframe[dataframe["Quantity"]>0]
-     dataframe = dataframe[dataframe["Price"]> 0]
-     replace_with_thresholds(dataframe, "Quantity")
-     replace_with_thresholds(dataframe, "Price")
-     dataframe["TotalPrice"]= dataframe["Quantity"] * dataframe["Price"]
+     # Missing values, cancellations, Price<=0 and Quantity<=0 are removed in one step, then outliers are clipped.
+     dataframe = clean_transactions(dataframe, winsorizer=Winsorizer(clip_lower=False))
      today_date=dt.datetime(2011, 12, 11)
 
-     cltv_df= dataframe.groupby("Customer ID").agg({"InvoiceDate":[lambda InvoiceDate: (InvoiceDate.max()-InvoiceDate.min()).days,
-                                                            lambda InvoiceDate: (today_date - InvoiceDate.min()).days],
-                                             "Invoice": lambda Invoice: Invoice.nunique(),
-                                             "TotalPrice": lambda TotalPrice: TotalPrice.sum()})
-     cltv_df.columns=cltv_df.columns.droplevel(0)
+     # n_jobs > 1 (or None for all cores) aggregates customer-id shards in parallel, the result is the same
+     # (only on large tables and multi-core machines, and the calling script needs if __name__ == "__main__":)
+     cltv_df = compute_customer_aggregates_parallel(dataframe, today_date, n_jobs=n_jobs,
+                                                    invoice_col="InvoiceNo")[["tenure", "T", "frequency", "monetary"]]
      cltv_df.columns=["Recency", "T", "Frequency", "Monetary"]
      cltv_df["Monetary"]= cltv_df["Monetary"] / cltv_df["Frequency"]
      cltv_df=cltv_df[(cltv_df["Frequency"]> 1)]
      cltv_df["Recency"]= cltv_df["Recency"] /7
      cltv_df["T"] = cltv_df["T"] /7
 
-     #2. Establishing the BG-NBD Model
-     bgf = BetaGeoFitter(penalizer_coef=0.001)
-     bgf.fit(cltv_df['Frequency'],
-             cltv_df['Recency'],
-             cltv_df['T'])
-
-     cltv_df["expected_purc_1_week"] = bgf.predict(1,
-                                                   cltv_df['Frequency'],
-                                                   cltv_df['Recency'],
-                                                   cltv_df['T'])
-
-     cltv_df["expected_purc_1_month"] = bgf.predict(4,
-                                                    cltv_df['Frequency'],
-                                                    cltv_df['Recency'],
-                                                    cltv_df['T'])
-
-     cltv_df["expected_purc_3_month"] = bgf.predict(12,
-                                                    cltv_df['Frequency'],
-                                                    cltv_df['Recency'],
-                                                    cltv_df['T'])
-     # 3. Establishing the GAMMA-GAMMA Model
-     ggf = GammaGammaFitter(penalizer_coef=0.01)
-     ggf.fit(cltv_df['Frequency'], cltv_df['Monetary'])
-     cltv_df["expected_average_profit"] = ggf.conditional_expected_average_profit(cltv_df['Frequency'],
-                                                                                  cltv_df['Monetary'])
+     # With cache_dir the fitted models and the prediction columns are stored under a fingerprint of cltv_df
+     # (ModelCache in crm_cltv.py): calls on the same data with another month / n_segments skip both fits.
+     cache = ModelCache(cache_dir)
+     key = cache.fingerprint(cltv_df, bgnbd_penalizer=0.001, gamma_gamma_penalizer=0.01)
+
+     def fit_models():
+          #2. Establishing the BG-NBD Model
+          # BetaGeoModel (crm_cltv.py) fits the same model as lifetimes' BetaGeoFitter with analytic derivatives
+          bgf = BetaGeoModel(penalizer_coef=0.001)
+          bgf.fit(cltv_df['Frequency'],
+                  cltv_df['Recency'],
+                  cltv_df['T'])
+
+          # 3. Establishing the GAMMA-GAMMA Model
+          # Both models are fitted on the distinct (frequency, recency, T) / (frequency, monetary) rows with counts
+          ggf = GammaGammaModel(penalizer_coef=0.01)
+          ggf.fit(cltv_df['Frequency'], cltv_df['Monetary'])
+          return bgf, ggf
+
+     bgf, ggf = cache.models(key, {"bgnbd": BetaGeoModel, "gamma_gamma": GammaGammaModel}, fit_models)
+
+     def predict_purchases():
+          # 1 week, 1 month and 3 months in one call (one column per horizon)
+          expected_purc = bgf.predict_horizons([1, 4, 12],
+                                               cltv_df['Frequency'],
+                                               cltv_df['Recency'],
+                                               cltv_df['T'])
+          return pd.DataFrame({"expected_purc_1_week": expected_purc[1],
+                               "expected_purc_1_month": expected_purc[4],
+                               "expected_purc_3_month": expected_purc[12],
+                               "expected_average_profit": ggf.conditional_expected_average_profit(
+                                    cltv_df['Frequency'], cltv_df['Monetary'])})
+
+     predictions = cache.columns(key, ["expected_purc_1_week", "expected_purc_1_month", "expected_purc_3_month",
+                                       "expected_average_profit"], predict_purchases)
+     cltv_df = cltv_df.join(predictions)
 
      # 4. Calculation of CLTV with BG-NBD and GG model.
-     cltv = ggf.customer_lifetime_value(bgf,
-                                        cltv_df['Frequency'],
-                                        cltv_df['Recency'],
-                                        cltv_df['T'],
-                                        cltv_df['Monetary'],
-                                        time=month, # 3 months
-                                        freq="W", # Frequency information of T.
-                                        discount_rate=0.01)
-
-     cltv = cltv.reset_index()
-     cltv_final = cltv_df.merge(cltv, on="Customer ID", how="left")
-     cltv_final["segment"] = pd.qcut(cltv_final["clv"], 4, labels=["D", "C", "B", "A"])
+     def predict_clv():
+          cltv = ggf.customer_lifetime_value(bgf,
+                                             cltv_df['Frequency'],
+                                             cltv_df['Recency'],
+                                             cltv_df['T'],
+                                             cltv_df['Monetary'],
+                                             time=month, # 3 months
+                                             freq="W", # Frequency information of T.
+                                             discount_rate=0.01)
+          return cltv.to_frame(f"clv_{month}")
+
+     cltv_df["clv"] = cache.columns(key, [f"clv_{month}"], predict_clv)[f"clv_{month}"]
+
+     cltv_final = cltv_df.reset_index()
+     # n_segments=4 gives the segments D, C, B, A (A: highest CLV)
+     cltv_final["segment"] = pd.qcut(cltv_final["clv"], n_segments,
+                                     labels=[chr(ord("A") + i) for i in reversed(range(n_segments))])
 
      return cltv_final
 
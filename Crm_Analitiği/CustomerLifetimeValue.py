@@ -34,17 +34,20 @@
 
 
 import pandas as pd
+from crm_data import load_online_retail
+from crm_preprocessing import clean_transactions
+from crm_rfm import compute_customer_aggregates
 from sklearn.preprocessing import MinMaxScaler
 pd.set_option('display.max_columns', None)
 # pd.set_option('display.max_rows', None)
 pd.set_option('display.float_format', lambda x: '%.3f' % x)
 
-df_ = pd.read_excel(r"C:\Users\Baris\PycharmProjects\PythonProject2022\Crm_Analysis\datasets\online_retail_II.xlsx",
-                     sheet_name="Year 2009-2010")
+df_ = load_online_retail(r"C:\Users\Baris\PycharmProjects\PythonProject2022\Crm_Analysis\datasets\online_retail_II.xlsx",
+                         sheet_name="Year 2009-2010")
 df = df_.copy()
 df.head()
 df.isnull().sum()
-df = df[~df["Invoice"].str.contains("C", na=False)]
+df = df[~df["is_cancelled"]]
 df.describe().T
 df = df[(df['Quantity'] > 0)]
 df.dropna(inplace=True)
@@ -144,13 +147,10 @@ cltv_c.to_csv("cltc_c.csv")
 def create_cltv_c(dataframe, profit=0.10):
 
      # Preparing the data
-     dataframe = dataframe[~dataframe["Invoice"].str.contains("C", na=False)]
-     dataframe = dataframe[(dataframe['Quantity'] > 0)]
-     dataframe.dropna(inplace=True)
-     dataframe["TotalPrice"] = dataframe["Quantity"] * dataframe["Price"]
-     cltv_c = dataframe.groupby('Customer ID').agg({'Invoice': lambda x: x.nunique(),
-                                                    'Quantity': lambda x: x.sum(),
-                                                    'TotalPrice': lambda x: x.sum()})
+     dataframe = clean_transactions(dataframe, rules=("cancelled", "quantity", "missing"))
+     # CLTV-C only needs counts and sums, so the date aggregates are skipped (today_date=None)
+     cltv_c = compute_customer_aggregates(dataframe, None, invoice_col="InvoiceNo", quantity_col="Quantity")
+     cltv_c = cltv_c[['frequency', 'total_unit', 'monetary']]
      cltv_c.columns = ['total_transaction', 'total_unit', 'total_price']
      # avg_order_value
      cltv_c['avg_order_value'] = cltv_c['total_price'] / cltv_c['total_transaction']
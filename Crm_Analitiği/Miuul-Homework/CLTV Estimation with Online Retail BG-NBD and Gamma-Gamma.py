@@ -28,6 +28,9 @@
 
 import datetime as dt
 import pandas as pd
+import crm_path  # puts the shared helpers (one folder up) on sys.path
+from crm_data import load_online_retail
+from crm_preprocessing import Winsorizer, clean_transactions
 import matplotlib.pyplot as plt
 from lifetimes import BetaGeoFitter
 from lifetimes import GammaGammaFitter
@@ -37,10 +40,9 @@ pd.set_option('display.max_columns', None)
 pd.set_option('display.width', 500)
 pd.set_option('display.float_format', lambda x: '%.4f' % x)
 from sklearn.preprocessing import MinMaxScaler
-pd.options.mode.chained_assignment =None
 
 # Step1: Read Online_retail_II 2010-2011 data
-df_=pd.read_excel(r"C:\Users\Baris\PycharmProjects\PythonProject2022\Crm_Analysis\datasets\online_retail_II.xlsx",sheet_name="Year 2010-2011")
+df_=load_online_retail(r"C:\Users\Baris\PycharmProjects\PythonProject2022\Crm_Analysis\datasets\online_retail_II.xlsx",sheet_name="Year 2010-2011")
 df= df_.copy()
 df.head()
 df.describe().T
@@ -71,17 +73,11 @@ df.info()
 # Data Preprocessing
 #############################
 
-df.dropna(inplace=True)
-df = df[~df["Invoice"].str.contains("C", na=False)]
-df = df[df["Price"] > 0]
-df = df[df["Quantity"] > 0]
-
-# We called a function to suppress outliers.
-replace_with_thresholds(df, "Quantity")
-replace_with_thresholds(df, "Price")
-
-# We will create the Total price variable. The total price paid for a product.
-df["TotalPrice"] = df["Quantity"] * df["Price"]
+# Missing values, cancelled invoices, Price<=0 and Quantity<=0 are removed with one combined mask,
+# outliers are suppressed with the same rounded thresholds as replace_with_thresholds and TotalPrice is added.
+# The report shows how many rows each rule removed and the peak memory of the step.
+df, cleaning_report = clean_transactions(df, winsorizer=Winsorizer(round_limits=True), report=True)
+cleaning_report
 
 today_date=dt.datetime(2011, 12, 11)
 
@@ -33,14 +33,17 @@
 
 import datetime as dt
 import pandas as pd
+import crm_path  # puts the shared helpers (one folder up) on sys.path
+from crm_data import load_online_retail
+from crm_rfm import SegmentMap, pack_scores
 
 pd.set_option('display.max_columns', None)
 # pd.set_option('display.max_rows',None) is not necessary as the rows will be crowded
 pd.set_option('display.float_format', lambda x: '%.3f' % x) # How many digits after the comma of the numeric digit?
 
 # Step 1: Read the 2010-2011 data in Online Retail II excel. Create a copy of the dataframe you created.
-df_ = pd.read_excel(r"C:\Users\Baris\PycharmProjects\PythonProject2022\Crm_Analysis\datasets\online_retail_II.xlsx",
-                     sheet_name="Year 2010-2011")
+df_ = load_online_retail(r"C:\Users\Baris\PycharmProjects\PythonProject2022\Crm_Analysis\datasets\online_retail_II.xlsx",
+                         sheet_name="Year 2010-2011")
 df = df_.copy()
 df.head()
 df.shape
@@ -78,7 +81,7 @@ df["Description"].value_counts().head()
 df.groupby("Description").agg({"Quantity": "sum"}).sort_values("Quantity", ascending=False).head(5)
 
 # Step 8: 'C' on the invoices indicates canceled transactions. Remove canceled transactions from the data set.
-df[~df["Invoice"].str.contains("C", na=False)]
+df[~df["is_cancelled"]]
 
 # Step 9: Create a variable called 'TotalPrice' that represents the total earnings per invoice
 df["TotalPrice"] = df["Quantity"] * df["Price"]
@@ -128,14 +131,14 @@ rfm["monetary_score"] = pd.qcut(rfm["monetary"], 5, labels=[1, 2, 3, 4, 5, ])
 rfm["frequency_score"] = pd.cut(rfm["frequency"].rank(method="first"), 5, labels=[1, 2, 3, 4, 5])
 
 # Step 3: Express recency_score and frequency_score as a single variable and save as RF_SCORE
-rfm["RFM_SCORE"] = (rfm["recency_score"].astype(str) +
-                     rfm["frequency_score"].astype(str))
+# The score is packed into one integer (recency 5, frequency 4 -> 54) instead of concatenating strings.
+rfm["RFM_SCORE"] = pack_scores(rfm["recency_score"], rfm["frequency_score"])
 rfm.head()
 # Who are our champion customers
-rfm[rfm["RFM_SCORE"] == "55"]
+rfm[rfm["RFM_SCORE"] == 55]
 
 # For less valuable customers
-rfm[rfm["RFM_SCORE"] == "11"]
+rfm[rfm["RFM_SCORE"] == 11]
 
 ####################
 # Task 4: Defining RF Score as a Segment
@@ -157,8 +160,9 @@ seg_map = {
 
 # Step 2: Convert the scores into segments with the help of the seg_map below.
 # Code that will allow us to capture the structure and capture two values
+# SegmentMap runs the seg_map regexes once on all 25 score pairs and then assigns segments by table lookup.
 
-rfm['segment'] = rfm['RFM_SCORE'].replace(seg_map, regex=True)
+rfm['segment'] = SegmentMap(seg_map).assign(rfm["recency_score"], rfm["frequency_score"])
 rfm[["segment", "recency", "frequency", "monetary"]].groupby("segment").agg(["mean", "count"])
 
 ##############
@@ -31,6 +31,10 @@
 ####################### #############
 
 import pandas as pd
+import crm_path  # puts the shared helpers (one folder up) on sys.path
+from crm_data import load_flo_data
+from crm_preprocessing import Winsorizer
+from crm_cltv import BetaGeoModel, GammaGammaModel
 import datetime as dt
 from lifetimes import BetaGeoFitter
 from lifetimes import GammaGammaFitter
@@ -44,10 +48,9 @@ pd.set_option("display.max_columns",None)
 
 # Take two digits after the comma
 pd.set_option("display.float_format", lambda x:"%3.f" % x)
-pd.options.mode.chained_assignment =None
 
 # Step1: Read flo_data_20K.csv data.
-df_=pd.read_csv(r"C:\Users\Baris\PycharmProjects\PythonProject2022\Crm_Analysis\datasets\flo_data_20k.csv")
+df_=load_flo_data(r"C:\Users\Baris\PycharmProjects\PythonProject2022\Crm_Analysis\datasets\flo_data_20k.csv")
 df= df_.copy()
 df.head()
 
@@ -73,9 +76,12 @@ def replace_with_thresholds(dataframe, variable):
 
 # Step3: "order_num_total_ever_online", "order_num_total_ever_offline", "customer_value_total_ever_offline","customer_value_total_ever_online"
 #--Suppress variables if they have outliers.
+#--Winsorizer does the same as replace_with_thresholds for all four columns at once (one quantile call, one clip per column).
+#--Its limits can be saved with save() and re-used for the next batch with Winsorizer.load().
 columns = ["order_num_total_ever_online", "order_num_total_ever_offline", "customer_value_total_ever_offline","customer_value_total_ever_online"]
-for col in columns:
-     replace_with_thresholds(df, col)
+winsorizer = Winsorizer(round_limits=True).fit(df, columns)
+winsorizer.limits_frame()
+winsorizer.transform(df)
 
 # Step4: Omnichannel means that customers shop both online and offline platforms. Create new variables for the total number of purchases and expenditures of each customer.
 df["order_num_total"] = df["order_num_total_ever_online"] + df["order_num_total_ever_offline"]
@@ -84,8 +90,7 @@ df["customer_value_total"] = df["customer_value_total_ever_offline"] + df["custo
 
 # Step5: Examine the variable types. Change the type of variables expressing date to date.
 df.info()
-date_columns = df.columns[df.columns.str.contains("date")]
-df[date_columns] = df[date_columns].apply(pd.to_datetime)
+#---load_flo_data already parses the date columns with a fixed format, no conversion is needed here.
 
 ####################### #
 # Task 2: Creating the CLTV Data Structure
@@ -235,13 +240,11 @@ def create_cltv_df(dataframe):
      # Preparing the Data
      columns = ["order_num_total_ever_online", "order_num_total_ever_offline", "customer_value_total_ever_offline",
                 "customer_value_total_ever_online"]
-     for col in columns:
-         replace_with_thresholds(dataframe, col)
+     Winsorizer(round_limits=True).fit_transform(dataframe, columns)
      df["order_num_total"] = df["order_num_total_ever_online"] + df["order_num_total_ever_offline"]
      df["customer_value_total"] = df["customer_value_total_ever_offline"] + df["customer_value_total_ever_online"]
      dataframe =dataframe[~(dataframe["customer_value_total"]==0) | (dataframe["order_num_total"]==0)]
-     date_columns = df.columns[df.columns.str.contains("date")]
-     df[date_columns] = df[date_columns].apply(pd.to_datetime)
+     # Date columns come already parsed from load_flo_data.
 
      # Creating CLTV Data Structure
      dataframe["last_order_date"].max() #2021-05-30
@@ -255,21 +258,22 @@ def create_cltv_df(dataframe):
      cltv_df= cltv_df[(cltv_df["frequency"] > 1)]
 
      # Establishing the BG-NBD Model
-     bgf = BetaGeoFitter(penalizer_coef=0.001)
+     # BetaGeoModel (crm_cltv.py) fits the same model as lifetimes' BetaGeoFitter with analytic derivatives
+     bgf = BetaGeoModel(penalizer_coef=0.001)
      bgf.fit(cltv_df["frequency"],
              cltv_df["recency_cltv_weekly"],
              cltv_df["T_weekly"])
-     cltv_df["exp_sales_3_month"] = bgf.predict(4 * 3,
-                                                cltv_df["frequency"],
-                                                cltv_df["recency_cltv_weekly"],
-                                                cltv_df["T_weekly"])
-     cltv_df["exp_sales_6_month"] = bgf.predict(4 * 6,
-                                                cltv_df["frequency"],
-                                                cltv_df["recency_cltv_weekly"],
-                                                cltv_df["T_weekly"])
+     # 3 and 6 months in one call (one column per horizon)
+     exp_sales = bgf.predict_horizons([4 * 3, 4 * 6],
+                                      cltv_df["frequency"],
+                                      cltv_df["recency_cltv_weekly"],
+                                      cltv_df["T_weekly"])
+     cltv_df["exp_sales_3_month"] = exp_sales[4 * 3]
+     cltv_df["exp_sales_6_month"] = exp_sales[4 * 6]
 
      # Establishing the Gamma-Gamma Model
-     ggf=GammaGammaFitter(penalizer_coef=0.01)
+     # Both models are fitted on the distinct (frequency, recency, T) / (frequency, monetary) rows with counts
+     ggf=GammaGammaModel(penalizer_coef=0.01)
      ggf.fit(cltv_df["frequency"], cltv_df["monetary_cltv_avg"])
      cltv_df["exp_average_value"]= ggf.conditional_expected_average_profit(cltv_df["frequency"],cltv_df["monetary_cltv_avg"])
 
@@ -4,6 +4,9 @@
 #######################
 
 import pandas as pd
+import crm_path  # puts the shared helpers (one folder up) on sys.path
+from crm_data import load_flo_data
+from crm_rfm import AudienceIndex, SegmentMap, pack_scores
 import datetime as dt
 # Show All Columns
 pd.set_option("display.max_columns",None)
@@ -18,7 +21,7 @@ pd.set_option("display.float_format", lambda x:"%2.f" % x)
 pd.set_option("display.width",100)
 
 # Step 1: Read the flo_data_20K.csv data. Create a copy of the dataframe.
-df_=pd.read_csv(r"C:\Users\Baris\PycharmProjects\PythonProject2022\Crm_Analysis\datasets\flo_data_20k.csv")
+df_=load_flo_data(r"C:\Users\Baris\PycharmProjects\PythonProject2022\Crm_Analysis\datasets\flo_data_20k.csv")
 df= df_.copy()
 df.head()
 
@@ -54,11 +57,7 @@ df["customer_value_total"].head()
 ##---Observing variable types
 df.info() #--Since some date variables appear categorical, we must change the variable type.
 
-##---Columns containing dates were transferred to data columns
-date_columns=df.columns[df.columns.str.contains("date")]
-
-##---Type assignment was made to these variables containing dates, and a dataframe was added.
-df[date_columns] = df[date_columns].apply(pd.to_datetime)
+##---load_flo_data already parses the date columns with a fixed format (and makes the channels categorical).
 df.info()
 
 
@@ -81,8 +80,7 @@ df.sort_values("order_num_total", ascending=False)[:10]
 def data_prep(dataframe):
      dataframe["order_num_total"]= dataframe["order_num_total_ever_online"]+dataframe["order_num_total_ever_offline"]
      dataframe["customer_value_total"] = dataframe["customer_value_total_ever_offline"] + dataframe["customer_value_total_ever_online"]
-     date_columns= dataframe.columns[dataframe.columns.str.contains("date")]
-     dataframe[date_columns]= dataframe[date_columns].apply(pd.to_datetime)
+     # Date columns come already parsed from load_flo_data.
      return df
 
 #######################
@@ -141,10 +139,11 @@ rfm["monetary_score"]= pd.qcut(rfm["monetary"], 5, labels=[1, 2, 3, 4, 5])
 rfm.head()
 
 # Step 3: Express recency_score and frequency_score as a single variable and save it as RF_SCORE.
-rfm["RF_SCORE"]= (rfm["recency_score"].astype(str) + rfm["frequency_score"].astype(str))
+#---The scores are packed into one integer (recency 5, frequency 4 -> 54) instead of concatenating strings.
+rfm["RF_SCORE"]= pack_scores(rfm["recency_score"], rfm["frequency_score"])
 rfm["RF_SCORE"].head()
 #---Recency_score and frequency_score and monetary_score should be expressed as a single variable and recorded as RFM_SCORE
-rfm["RFM_SCORE"]= (rfm["recency_score"].astype(str) + rfm["frequency_score"].astype(str) + rfm["monetary_score"].astype(str))
+rfm["RFM_SCORE"]= pack_scores(rfm["recency_score"], rfm["frequency_score"], rfm["monetary_score"])
 rfm.head()
 
 #######################
@@ -165,7 +164,7 @@ seg_map = {
 }
 
 # Step 2: Convert the scores into segments with the help of the seg_map below.
-rfm["segment"]= rfm["RF_SCORE"].replace(seg_map,regex=True)
+rfm["segment"] = SegmentMap(seg_map).assign(rfm["recency_score"], rfm["frequency_score"])
 
 #############################
 # Mission 5: Action Time!
@@ -181,11 +180,13 @@ rfm[["segment", "recency", "frequency", "monetary"]].groupby("segment").agg(["me
   # -above your preferences. For this reason, it is desired to communicate specifically with customers who will be interested in the promotion of the brand and product sales.
   # -Customers who will be contacted specifically are loyal customers (champions, loyal_customers) and people who shop in the female category.
   # -Save the ID numbers of these customers in the csv file.
-  #--Keep the IDs of RFM segment champions and loyal customers
-target_segments_customer_ids= rfm[rfm["segment"].isin(["champions","loyal_customers"])]["customer_id"]
+  #--The audience index keeps one bitmap per segment, category and channel, so the campaign lists are
+  #--bit operations instead of isin() scans over the master_id strings
+audiences = AudienceIndex.from_flo(df, rfm)
 
-  #--we kept master id in target segments customer id and female ones in cust_ids
-cust_ids=df[(df["master_id"].isin(target_segments_customer_ids)) & (df["interested_in_categories_12"].str.contains("WOMEN"))]["master_id"]
+  #--champions or loyal customers AND interested in the women (KADIN) category
+cust_ids = audiences.customers(audiences.any_of("segment", ["champions", "loyal_customers"])
+                               & audiences["category", "KADIN"])
 
 #--cust_ids was a pandas series, we saved it as the new brand target customer_id.csv
 cust_ids.to_csv("yeni_marka_target_customer_id.csv", index=False)
@@ -209,8 +210,10 @@ seg_map = {
      r'[4-5][2-3]': 'potential_loyalists',
      r'5[4-5]': 'champions'
 }
-target_segments_customer_ids= rfm[rfm["segment"].isin(["cant_loose","at_Risk","new_customers"])]["customer_id"]
-cust_ids= df[(df["master_id"].isin(target_segments_customer_ids))& ((df["interested_in_categories_12"].str.contains("MALE"))|(df["interested_in_categories_12"].str.contains(" CHILD")))]["master_id"]
+  #--Men (ERKEK) or children (COCUK); an exact bit test, so women-only customers are not matched by mistake
+cust_ids = audiences.customers(audiences.any_of("segment", ["cant_loose", "at_Risk", "new_customers"])
+                               & audiences.any_of("category", ["ERKEK", "COCUK"]))
+  #--further conditions combine the same way, e.g. & ~audiences["last_order_channel", "Offline"]
 
   # -Save the IDs of the customers with the appropriate profile in the csv file.
 cust_ids.to_csv("discount_target_customer_ids.csv", index=False)
@@ -224,8 +227,7 @@ def create_rfm(dataframe):
     # Preparing the Data
     df["order_num_total"] = df["order_num_total_ever_online"] + df["order_num_total_ever_offline"]
     df["customer_value_total"] = df["customer_value_total_ever_offline"] + df["customer_value_total_ever_online"]
-    date_columns = df.columns[df.columns.str.contains("date")]
-    df[date_columns] = df[date_columns].apply(pd.to_datetime)
+    # Date columns come already parsed from load_flo_data.
 
     # Calculation of RFM Metrics
     df["last_order_date"].max() # 2021-05-30
@@ -237,11 +239,11 @@ def create_rfm(dataframe):
     rfm["monetary"] = df["customer_value_total"]
 
     # Calculation of RF and RFM Scores
-    rfm["recency_score"] = pd.qcut(rfm["recency"], 5, labels=[5, 4, 3, 2, 1])
-    rfm["frequency_score"] = pd.qcut(rfm["frequency"].rank(method="first"), 5, labels=[1, 2, 3, 4, 5])
-    rfm["monetary_score"] = pd.qcut(rfm["monetary"], 5, labels=[1, 2, 3, 4, 5])
-    rfm["RF_SCORE"] = (rfm["recency_score"].astype(str) + rfm["frequency_score"].astype(str))
-    rfm["RFM_SCORE"] = ( rfm["recency_score"].astype(str) + rfm["frequency_score"].astype(str) + rfm["monetary_score"].astype(str))
+    rfm["recency_score"] = pd.qcut(rfm["recency"], 5, labels=[5, 4, 3, 2, 1]).astype("uint8")
+    rfm["frequency_score"] = pd.qcut(rfm["frequency"].rank(method="first"), 5, labels=[1, 2, 3, 4, 5]).astype("uint8")
+    rfm["monetary_score"] = pd.qcut(rfm["monetary"], 5, labels=[1, 2, 3, 4, 5]).astype("uint8")
+    rfm["RF_SCORE"] = pack_scores(rfm["recency_score"], rfm["frequency_score"])
+    rfm["RFM_SCORE"] = pack_scores(rfm["recency_score"], rfm["frequency_score"], rfm["monetary_score"])
 
     # Naming Segments
     seg_map = {
@@ -257,7 +259,7 @@ def create_rfm(dataframe):
         r'5[4-5]': 'champions'
     }
 
-    rfm["segment"] = rfm["RF_SCORE"].replace(seg_map, regex=True)
+    rfm["segment"] = SegmentMap(seg_map).assign(rfm["recency_score"], rfm["frequency_score"])
     return rfm[["customer_id", "recency", "frequency", "monetary", "RF_SCORE", "RFM_SCORE", "segment"]]
 
     # return: Extract as a usable object
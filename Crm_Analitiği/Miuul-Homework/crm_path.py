@@ -0,0 +1,14 @@
+####################### #############
+# Shared Helper Path
+####################### #############
+
+# The shared helpers (crm_data.py, crm_rfm.py ...) live one folder up, next to the main analysis scripts.
+# The homework scripts import this module first, so that the helpers can be imported wherever the repo is cloned.
+
+import sys
+from pathlib import Path
+
+HELPERS_DIR = str(Path(__file__).resolve().parents[1])
+
+if HELPERS_DIR not in sys.path:
+    sys.path.append(HELPERS_DIR)
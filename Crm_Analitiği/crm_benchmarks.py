@@ -0,0 +1,447 @@
+####################### #############
+# Benchmarks for the Shared CRM Helpers
+####################### #############
+
+# Each section times a helper from crm_data / crm_rfm against the code it replaced in the analysis scripts
+# and checks that both give the same result. Run the whole file as a script (python crm_benchmarks.py): the body
+# sits under the __main__ guard because the parallel section starts worker processes, which re-import this module
+# under the spawn start method (Windows, macOS).
+
+import datetime as dt
+import os
+import tempfile
+import timeit
+
+import pandas as pd
+from lifetimes import BetaGeoFitter, GammaGammaFitter
+
+from crm_cltv import BetaGeoModel, GammaGammaModel, ModelCache
+from crm_data import compact_transactions, interested_in, load_flo_data, load_online_retail
+from crm_preprocessing import Winsorizer, clean_transactions
+from crm_rfm import (SEG_MAP, AudienceIndex, RFMSketchScorer, RFMState, SegmentMap, compare_frequency_engines,
+                     compare_sketch_scores, compute_customer_aggregates, compute_customer_aggregates_parallel,
+                     create_rfm_snapshots, migration_matrix, score_rfm, segment_transitions)
+
+DATA_PATH = r"C:\Users\Baris\PycharmProjects\PythonProject2022\Crm_Analysis\datasets\online_retail_II.xlsx"
+FLO_PATH = r"C:\Users\Baris\PycharmProjects\PythonProject2022\Crm_Analysis\datasets\flo_data_20k.csv"
+
+
+# Prints the best of a few runs in milliseconds and returns the result of the last run.
+def time_it(name, func, repeat=3):
+    result = []
+    best = min(timeit.repeat(lambda: result.append(func()), number=1, repeat=repeat))
+    print(f"{name:<45}{best * 1000:>10.1f} ms")
+    return result[-1]
+
+
+if __name__ == "__main__":
+    df_ = load_online_retail(DATA_PATH, sheet_name="Year 2010-2011")
+    df = df_.dropna()
+    df = df[~df["Invoice"].str.contains("C", na=False)].copy()
+    df["TotalPrice"] = df["Quantity"] * df["Price"]
+    today_date = dt.datetime(2011, 12, 11)
+
+    #############################
+    # Customer Aggregates (user-003)
+    #############################
+
+    def lambda_rfm(dataframe):
+        return dataframe.groupby('Customer ID').agg({'InvoiceDate': lambda date: (today_date - date.max()).days,
+                                                     'Invoice': lambda num: num.nunique(),
+                                                     "TotalPrice": lambda price: price.sum()})
+
+
+    def lambda_cltv_p(dataframe):
+        return dataframe.groupby("Customer ID").agg({"InvoiceDate": [lambda InvoiceDate: (InvoiceDate.max() - InvoiceDate.min()).days,
+                                                                     lambda InvoiceDate: (today_date - InvoiceDate.min()).days],
+                                                     "Invoice": lambda Invoice: Invoice.nunique(),
+                                                     "TotalPrice": lambda TotalPrice: TotalPrice.sum()})
+
+
+    old_rfm = time_it("lambda agg (create_rfm)", lambda: lambda_rfm(df))
+    old_cltv = time_it("lambda agg (create_cltv_p)", lambda: lambda_cltv_p(df))
+    new = time_it("compute_customer_aggregates", lambda: compute_customer_aggregates(df, today_date))
+
+    assert (old_rfm.iloc[:, 0].values == new["recency"].values).all()
+    assert (old_cltv.iloc[:, 0].values == new["tenure"].values).all()
+    assert (old_cltv.iloc[:, 1].values == new["T"].values).all()
+    assert (old_rfm.iloc[:, 1].values == new["frequency"].values).all()
+    assert ((old_rfm.iloc[:, 2] - new["monetary"]).abs().max() < 1e-6)
+
+    #############################
+    # Winsorizer (user-004)
+    #############################
+
+    def outlier_thresholds(dataframe, variable):
+        quartile1 = dataframe[variable].quantile(0.01)
+        quartile3 = dataframe[variable].quantile(0.99)
+        interquantile_range = quartile3 - quartile1
+        up_limit = quartile3 + 1.5 * interquantile_range
+        low_limit = quartile1 - 1.5 * interquantile_range
+        return low_limit, up_limit
+
+
+    def replace_with_thresholds(dataframe, variable):
+        low_limit, up_limit = outlier_thresholds(dataframe, variable)
+        dataframe.loc[(dataframe[variable] < low_limit), variable] = low_limit
+        dataframe.loc[(dataframe[variable] > up_limit), variable] = up_limit
+
+
+    def old_winsorize(dataframe):
+        dataframe = dataframe.astype({"Quantity": "float64"})
+        for col in ["Quantity", "Price"]:
+            replace_with_thresholds(dataframe, col)
+        return dataframe
+
+
+    old = time_it("replace_with_thresholds loop", lambda: old_winsorize(df))
+    new = time_it("Winsorizer", lambda: Winsorizer().fit_transform(df.copy(), ["Quantity", "Price"]))
+
+    assert (old[["Quantity", "Price"]].values == new[["Quantity", "Price"]].values).all()
+
+
+    # The homework version: compared with the exact limits, replaced by the rounded limits.
+    def replace_with_rounded_thresholds(dataframe, variable):
+        low_limit, up_limit = outlier_thresholds(dataframe, variable)
+        dataframe.loc[(dataframe[variable] < low_limit), variable] = round(low_limit, 0)
+        dataframe.loc[(dataframe[variable] > up_limit), variable] = round(up_limit, 0)
+
+
+    old = df.astype({"Quantity": "float64"})
+    for col in ["Quantity", "Price"]:
+        replace_with_rounded_thresholds(old, col)
+    new = Winsorizer(round_limits=True).fit_transform(df.copy(), ["Quantity", "Price"])
+    assert (old[["Quantity", "Price"]].values == new[["Quantity", "Price"]].values).all()
+
+    #############################
+    # Invoice Encoding (user-005)
+    #############################
+
+    old = time_it('Invoice.str.contains("C")', lambda: df_[~df_["Invoice"].str.contains("C", na=False)])
+    new = time_it("~is_cancelled", lambda: df_[~df_["is_cancelled"]])
+    assert old.index.equals(new.index)
+
+    old = time_it("nunique on Invoice strings", lambda: df.groupby("Customer ID")["Invoice"].nunique())
+    new = time_it("nunique on InvoiceNo integers", lambda: df.groupby("Customer ID")["InvoiceNo"].nunique())
+    assert old.equals(new)
+
+    #############################
+    # Compact Types (user-007)
+    #############################
+
+    compact_df_ = compact_transactions(df_)
+    memory = pd.DataFrame({"full_mb": df_.memory_usage(deep=True) / 1024 ** 2,
+                           "compact_mb": compact_df_.memory_usage(deep=True) / 1024 ** 2})
+    memory.loc["total"] = memory.sum()
+    memory["ratio"] = memory["full_mb"] / memory["compact_mb"]
+    print(memory)
+
+    full = compute_customer_aggregates(clean_transactions(df_), today_date, invoice_col="InvoiceNo")
+    compact = compute_customer_aggregates(clean_transactions(compact_df_), today_date, invoice_col="InvoiceNo")
+    compact.index = compact.index.astype("float64")
+
+    # Dropping the time of day can move day differences by one day, everything else must match.
+    assert full.index.equals(compact.index)
+    assert (full[["recency", "T", "tenure"]] - compact[["recency", "T", "tenure"]]).abs().max().max() <= 1
+    assert (full["frequency"] == compact["frequency"]).all()
+    assert ((full["monetary"] - compact["monetary"]).abs() / full["monetary"].abs()).max() < 1e-4
+
+    full_score = pd.qcut(full["recency"], 5, labels=False, duplicates="drop")
+    compact_score = pd.qcut(compact["recency"], 5, labels=False, duplicates="drop")
+    print(f"recency score agreement full vs compact: {(full_score == compact_score).mean():.2%}")
+
+
+    # The steps of create_cltv_p (CustomerLifeTimeValuePrediction.py): 3-month CLV and its 4 segments.
+    def cltv_prediction(transactions):
+        cltv = compute_customer_aggregates(clean_transactions(transactions, winsorizer=Winsorizer(clip_lower=False)),
+                                           today_date, invoice_col="InvoiceNo")
+        cltv = cltv[["tenure", "T", "frequency", "monetary"]]
+        cltv.index = cltv.index.astype("float64")
+        cltv = cltv[cltv["frequency"] > 1]
+        inputs = (cltv["frequency"], cltv["tenure"] / 7, cltv["T"] / 7)
+        monetary_avg = cltv["monetary"] / cltv["frequency"]
+        bgf = BetaGeoModel(penalizer_coef=0.001).fit(*inputs)
+        ggf = GammaGammaModel(penalizer_coef=0.01).fit(cltv["frequency"], monetary_avg)
+        clv = ggf.customer_lifetime_value(bgf, *inputs, monetary_avg, time=3, freq="W", discount_rate=0.01)
+        return pd.DataFrame({"clv": clv, "segment": pd.qcut(clv, 4, labels=["D", "C", "B", "A"])})
+
+
+    # Float32 prices and day-level dates move the fitted parameters a little; the CLV and its segments must stay close.
+    full = cltv_prediction(df_)
+    compact = cltv_prediction(compact_df_)
+    assert full.index.equals(compact.index)
+    clv_difference = ((full["clv"] - compact["clv"]).abs() / full["clv"].abs()).mean()
+    segment_agreement = (full["segment"] == compact["segment"]).mean()
+    print(f"create_cltv_p full vs compact: mean relative clv difference {clv_difference:.3%}, "
+          f"segment agreement {segment_agreement:.2%}")
+    assert clv_difference < 0.02
+    assert segment_agreement > 0.99
+
+    #############################
+    # Incremental RFM State (user-011)
+    #############################
+
+    # The same 1000-row batch absorbed into states of growing size; the time should not grow with the state.
+    batch = df_.iloc[:1000].copy()
+    for n_customers in [10_000, 1_000_000, 4_000_000]:
+        state = RFMState()
+        customer_ids = pd.Index(range(n_customers), dtype="float64", name="Customer ID")
+        state.customers = pd.DataFrame({"first_date": pd.Timestamp("2010-12-01"),
+                                        "last_date": pd.Timestamp("2011-06-01"),
+                                        "frequency": 1,
+                                        "monetary": 1.0}, index=customer_ids)
+        # half of the batch customers are known, half are new
+        batch["Customer ID"] = (batch.index % 2 * n_customers + batch.index).astype("float64")
+        time_it(f"RFMState.update, {n_customers} customers", lambda: state.update(batch))
+
+    #############################
+    # Sketch Scores (user-012)
+    #############################
+
+    rfm = compute_customer_aggregates(clean_transactions(df_, rules=("missing", "cancelled")), today_date,
+                                      invoice_col="InvoiceNo")[["recency", "frequency", "monetary"]]
+    rfm = rfm[rfm["monetary"] > 0]
+    print(compare_sketch_scores(rfm, k=200, chunksize=1000, seed=42))
+
+    # Scoring the same customers again (in one piece or in chunks) must give the same scores.
+    scorer = RFMSketchScorer(k=200, seed=42).update(rfm)
+    first_pass = scorer.score(rfm)
+    assert first_pass.equals(scorer.score(rfm))
+    rfm_chunks = [rfm.iloc[start:start + 1000] for start in range(0, len(rfm), 1000)]
+    for _ in range(2):
+        assert pd.concat([scorer.score(chunk) for chunk in rfm_chunks]).equals(first_pass)
+
+    #############################
+    # Segment Lookup (user-013)
+    #############################
+
+    seg_map = {r'[1-2][1-2]': 'hibernating',
+               r'[1-2][3-4]': 'at_Risk',
+               r'[1-2]5': 'cant_loose',
+               r'3[1-2]': 'about_to_sleep',
+               r'33': 'need_attention',
+               r'[3-4][4-5]': 'loyal_customers',
+               r'41': 'promising',
+               r'51': 'new_customers',
+               r'[4-5][2-3]': 'potential_loyalists',
+               r'5[4-5]': 'champions'}
+
+    rfm["recency_score"] = pd.qcut(rfm["recency"], 5, labels=[5, 4, 3, 2, 1])
+    rfm["frequency_score"] = pd.qcut(rfm["frequency"].rank(method="first"), 5, labels=[1, 2, 3, 4, 5])
+    rfm["RFM_SCORE"] = rfm["recency_score"].astype(str) + rfm["frequency_score"].astype(str)
+
+    old = time_it("RFM_SCORE.replace(seg_map, regex=True)", lambda: rfm["RFM_SCORE"].replace(seg_map, regex=True))
+    new = time_it("SegmentMap.assign", lambda: SegmentMap(seg_map).assign(rfm["recency_score"], rfm["frequency_score"]))
+    assert (old == new.astype(str)).all()
+
+    #############################
+    # HyperLogLog Frequency (user-016)
+    #############################
+
+    transactions = clean_transactions(df_, rules=("missing", "cancelled"))
+    for error in [0.05, 0.02, 0.01]:
+        # exact_limit=16 forces the heavier customers onto the HLL registers, the default keeps most of them exact.
+        print(f"error={error}")
+        print(compare_frequency_engines(transactions, error=error, exact_limit=16, chunksize=50_000))
+
+    #############################
+    # Sharded Parallel Aggregates (user-017)
+    #############################
+
+    # The table is repeated with shifted customer ids up to about 2 million rows, the size of the cleaned
+    # Online Retail II data, and min_rows_per_job=1 forces the workers so every n_jobs is measured.
+    # The speedup can only grow up to the number of cores of the machine.
+    repeats = -(-2_000_000 // len(transactions))
+    max_customer = transactions["Customer ID"].max() + 1
+    large = pd.concat([transactions.assign(**{"Customer ID": transactions["Customer ID"] + i * max_customer})
+                       for i in range(repeats)], ignore_index=True)
+    print(f"cores: {os.cpu_count()}, rows: {len(large)}")
+    serial = compute_customer_aggregates(large, today_date, invoice_col="InvoiceNo")
+    serial_time = min(timeit.repeat(lambda: compute_customer_aggregates(large, today_date, invoice_col="InvoiceNo"),
+                                    number=1, repeat=3))
+    print(f"{'serial':<20}{serial_time * 1000:>10.1f} ms")
+    for n_jobs in [2, 4, 8]:
+        def aggregate_in_parallel():
+            return compute_customer_aggregates_parallel(large, today_date, n_jobs=n_jobs, min_rows_per_job=1,
+                                                        invoice_col="InvoiceNo")
+        pd.testing.assert_frame_equal(serial, aggregate_in_parallel())
+        parallel_time = min(timeit.repeat(aggregate_in_parallel, number=1, repeat=3))
+        print(f"{f'n_jobs={n_jobs}':<20}{parallel_time * 1000:>10.1f} ms   speedup {serial_time / parallel_time:.2f}x")
+    # the default threshold runs small tables serially
+    pd.testing.assert_frame_equal(compute_customer_aggregates(transactions, today_date, invoice_col="InvoiceNo"),
+                                  compute_customer_aggregates_parallel(transactions, today_date, n_jobs=4,
+                                                                       invoice_col="InvoiceNo"))
+
+    #############################
+    # RFM Snapshots (user-018)
+    #############################
+
+    snapshot_dates = pd.date_range("2011-01-01", "2011-12-01", freq="MS").append(pd.DatetimeIndex([today_date]))
+
+
+    def snapshots_one_by_one():
+        frames = []
+        for date in snapshot_dates:
+            rfm_at = compute_customer_aggregates(transactions[transactions["InvoiceDate"] < date], date,
+                                                 invoice_col="InvoiceNo")[["recency", "frequency", "monetary"]]
+            rfm_at = score_rfm(rfm_at[rfm_at["monetary"] > 0], SegmentMap(SEG_MAP))
+            frames.append(rfm_at.assign(date=date).reset_index())
+        return pd.concat(frames, ignore_index=True)
+
+
+    old = time_it(f"{len(snapshot_dates)} x create_rfm", snapshots_one_by_one)
+    new = time_it("create_rfm_snapshots", lambda: create_rfm_snapshots(transactions, snapshot_dates))
+    assert (old["segment"] == new["segment"]).all() and (old["frequency"] == new["frequency"]).all()
+
+    #############################
+    # Segment Migration (user-019)
+    #############################
+
+    snapshots = new
+    transitions = time_it("segment_transitions", lambda: segment_transitions(snapshots, value_col="monetary"))
+    print(migration_matrix(transitions, normalize=True).round(2))
+
+    # the same period with a crosstab of string segments
+    period_from, period_to = snapshot_dates[-3], snapshot_dates[-2]
+    segments_from = snapshots[snapshots["date"] == period_from].set_index("Customer ID")["segment"].astype(str)
+    segments_to = snapshots[snapshots["date"] == period_to].set_index("Customer ID")["segment"].astype(str)
+    both = pd.concat([segments_from, segments_to], axis=1, keys=["from", "to"]).fillna("(none)")
+    crosstab = pd.crosstab(both["from"], both["to"])
+    matrix = migration_matrix(transitions, date_from=period_from)
+    matrix.index, matrix.columns = matrix.index.astype(str), matrix.columns.astype(str)
+    matrix = matrix.loc[crosstab.index, crosstab.columns]
+    assert (matrix.to_numpy() == crosstab.to_numpy()).all()
+
+    #############################
+    # Audience Index (user-020)
+    #############################
+
+    flo = load_flo_data(FLO_PATH)
+    # stand-in segments, the index only needs a customer_id -> segment table
+    flo_rfm = pd.DataFrame({"customer_id": flo["master_id"],
+                            "segment": pd.Categorical.from_codes(flo.index % 10, SegmentMap(SEG_MAP).categories)})
+    audiences = time_it("AudienceIndex.from_flo", lambda: AudienceIndex.from_flo(flo, flo_rfm))
+
+
+    def isin_campaign():
+        target_ids = flo_rfm[flo_rfm["segment"].isin(["champions", "loyal_customers"])]["customer_id"]
+        return flo[flo["master_id"].isin(target_ids) & interested_in(flo, any_of=["KADIN"])]["master_id"]
+
+
+    old = time_it("segment isin + master_id isin", isin_campaign)
+    new = time_it("AudienceIndex query", lambda: audiences.customers(
+        audiences.any_of("segment", ["champions", "loyal_customers"]) & audiences["category", "KADIN"]))
+    assert (old.to_numpy() == new.to_numpy()).all()
+
+    #############################
+    # BG-NBD Fitter (user-021)
+    #############################
+
+    cltv_df = compute_customer_aggregates(clean_transactions(df_, winsorizer=Winsorizer(clip_lower=False)), today_date,
+                                          invoice_col="InvoiceNo")[["tenure", "T", "frequency", "monetary"]]
+    cltv_df = cltv_df[cltv_df["frequency"] > 1]
+    cltv_df["recency_weekly"] = cltv_df["tenure"] / 7
+    cltv_df["T_weekly"] = cltv_df["T"] / 7
+    bgnbd_inputs = (cltv_df["frequency"], cltv_df["recency_weekly"], cltv_df["T_weekly"])
+
+    old = time_it("lifetimes BetaGeoFitter.fit", lambda: BetaGeoFitter(penalizer_coef=0.001).fit(*bgnbd_inputs))
+    new = time_it("BetaGeoModel.fit", lambda: BetaGeoModel(penalizer_coef=0.001).fit(*bgnbd_inputs))
+    print(pd.DataFrame({"lifetimes": old.params_, "BetaGeoModel": new.params_}))
+    print(f"objective lifetimes: {old._negative_log_likelihood_:.8f}  BetaGeoModel: {new.negative_log_likelihood_:.8f}")
+    # compare the optimum and the predictions; when a parameter runs to 0 both stop somewhere on the flat boundary
+    assert new.negative_log_likelihood_ <= old._negative_log_likelihood_ + 1e-6
+    print("max difference of predict(12):",
+          (new.predict(12, *bgnbd_inputs) - old.predict(12, *bgnbd_inputs)).abs().max())
+
+    #############################
+    # Sufficient-Statistic Compression (user-022)
+    #############################
+
+    # Compression only pays when customers share their (frequency, recency, T) tuple, e.g. with whole weeks.
+    print("distinct (frequency, recency, T):",
+          len(cltv_df[["frequency", "recency_weekly", "T_weekly"]].drop_duplicates()), "of", len(cltv_df))
+    whole_weeks = (cltv_df["frequency"], cltv_df["tenure"] // 7, cltv_df["T"] // 7)
+    print("with whole weeks:", len(pd.DataFrame(whole_weeks).T.drop_duplicates()))
+    full = time_it("BetaGeoModel.fit compress=False", lambda: BetaGeoModel(0.001).fit(*whole_weeks, compress=False))
+    compressed = time_it("BetaGeoModel.fit compress=True", lambda: BetaGeoModel(0.001).fit(*whole_weeks))
+    assert ((full.params_ - compressed.params_).abs() / full.params_.abs()).max() < 1e-6
+
+    cltv_df["monetary_avg"] = cltv_df["monetary"] / cltv_df["frequency"]
+    ggf_old = time_it("lifetimes GammaGammaFitter.fit", lambda: GammaGammaFitter(0.01).fit(cltv_df["frequency"],
+                                                                                           cltv_df["monetary_avg"]))
+    ggf_new = time_it("GammaGammaModel.fit", lambda: GammaGammaModel(0.01).fit(cltv_df["frequency"],
+                                                                               cltv_df["monetary_avg"]))
+    print(pd.DataFrame({"lifetimes": ggf_old.params_, "GammaGammaModel": ggf_new.params_}))
+
+    bgf = BetaGeoModel(0.001).fit(*bgnbd_inputs)
+    clv_inputs = bgnbd_inputs + (cltv_df["monetary_avg"],)
+    old = time_it("lifetimes customer_lifetime_value", lambda: ggf_old.customer_lifetime_value(
+        bgf, *clv_inputs, time=3, freq="W", discount_rate=0.01))
+    new = time_it("GammaGammaModel.customer_lifetime_value", lambda: ggf_new.customer_lifetime_value(
+        bgf, *clv_inputs, time=3, freq="W", discount_rate=0.01))
+    print("max relative difference of clv:", ((old - new).abs() / old.abs()).max())
+
+    #############################
+    # Multi-Horizon Prediction (user-023)
+    #############################
+
+    horizons = [1, 4, 12, 24, 48]
+    old = time_it("predict once per horizon",
+                  lambda: pd.DataFrame({h: bgf.predict(h, *bgnbd_inputs) for h in horizons}))
+    new = time_it("predict_horizons", lambda: bgf.predict_horizons(horizons, *bgnbd_inputs))
+    assert (old - new).abs().max().max() < 1e-12
+
+    #############################
+    # Warm-Started Refits (user-024)
+    #############################
+
+    # "tomorrow": 1% of the customers leave the sample and everybody is one day older
+    yesterday_bgf = BetaGeoModel(0.001).fit(*bgnbd_inputs)
+    yesterday_ggf = GammaGammaModel(0.01).fit(cltv_df["frequency"], cltv_df["monetary_avg"])
+    tomorrow = cltv_df.sample(frac=0.99, random_state=42)
+    tomorrow_inputs = (tomorrow["frequency"], tomorrow["recency_weekly"], tomorrow["T_weekly"] + 1 / 7)
+
+    cold = time_it("BetaGeoModel.fit cold start", lambda: BetaGeoModel(0.001).fit(*tomorrow_inputs))
+    warm = time_it("BetaGeoModel.fit warm start", lambda: BetaGeoModel(0.001).fit(*tomorrow_inputs,
+                                                                                   warm_start=yesterday_bgf))
+    print(pd.DataFrame({"cold": cold.diagnostics_, "warm": warm.diagnostics_}))
+    assert warm.negative_log_likelihood_ <= cold.negative_log_likelihood_ + 1e-9
+
+    cold = time_it("GammaGammaModel.fit cold start", lambda: GammaGammaModel(0.01).fit(tomorrow["frequency"],
+                                                                                       tomorrow["monetary_avg"]))
+    warm = time_it("GammaGammaModel.fit warm start", lambda: GammaGammaModel(0.01).fit(
+        tomorrow["frequency"], tomorrow["monetary_avg"], warm_start=yesterday_ggf))
+    print(pd.DataFrame({"cold": cold.diagnostics_, "warm": warm.diagnostics_}))
+
+    #############################
+    # Model Cache (user-025)
+    #############################
+
+    model_classes = {"bgnbd": BetaGeoModel, "gamma_gamma": GammaGammaModel}
+    summary = cltv_df[["frequency", "recency_weekly", "T_weekly", "monetary_avg"]]
+
+
+    def fit_models():
+        return (BetaGeoModel(0.001).fit(*bgnbd_inputs),
+                GammaGammaModel(0.01).fit(cltv_df["frequency"], cltv_df["monetary_avg"]))
+
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = ModelCache(cache_dir)
+        key = time_it("ModelCache.fingerprint", lambda: cache.fingerprint(summary, penalizers=(0.001, 0.01)))
+        fitted = time_it("fit BG-NBD + Gamma-Gamma", fit_models)
+        cache.models(key, model_classes, fit_models)
+        loaded = time_it("ModelCache.models (stored)", lambda: cache.models(key, model_classes, fit_models))
+        for fitted_model, loaded_model in zip(fitted, loaded):
+            assert (fitted_model.params_ - loaded_model.params_).abs().max() < 1e-9
+
+        # a changed customer gives another fingerprint
+        changed = summary.copy()
+        changed.iloc[0, 0] += 1
+        assert cache.fingerprint(changed, penalizers=(0.001, 0.01)) != key
+
+        # with room for one entry only the least recently used one is removed
+        small_cache = ModelCache(cache_dir, max_bytes=cache.size())
+        other_key = small_cache.fingerprint(changed, penalizers=(0.001, 0.01))
+        small_cache.columns(other_key, ["clv"], lambda: pd.DataFrame({"clv": changed["monetary_avg"]}))
+        assert [entry_key for _, entry_key, _ in small_cache._entries()] == [other_key]
@@ -0,0 +1,547 @@
+####################### #############
+# CLTV Model Building Blocks
+####################### #############
+
+# In-project BG-NBD and Gamma-Gamma estimators for create_cltv_p / create_cltv_df.
+# BetaGeoModel can be used wherever the scripts use lifetimes.BetaGeoFitter: fit(), predict(),
+# conditional_expected_number_of_purchases_up_to_time() and as the transaction model of
+# GammaGammaFitter.customer_lifetime_value(). GammaGammaModel does the same for lifetimes.GammaGammaFitter.
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import minimize
+from scipy.special import gammaln, hyp2f1, polygamma, psi
+
+BGNBD_PARAMS = ["r", "alpha", "a", "b"]
+GAMMA_GAMMA_PARAMS = ["p", "q", "v"]
+
+
+####################### #############
+# Sufficient Statistics
+####################### #############
+
+# Both models only see a customer through a few numbers: (frequency, recency, T) for BG-NBD and
+# (frequency, monetary) for Gamma-Gamma. With weekly recency / T and small integer frequencies many customers
+# share the same tuple, so the likelihood is evaluated once per distinct tuple with the number of customers
+# as weight (Fader and Hardie fit the CDNOW data the same way) and predictions are computed per tuple and
+# broadcast back. The weighted sums are the same sums, so the results do not change.
+
+# Distinct rows of the given columns: (list of unique columns, summed weights, inverse) with
+# columns[i] == unique[i][inverse].
+# The rows are grouped with a hash-based groupby, which is much faster than np.unique(axis=0).
+def compress_rows(*columns, weights=None):
+    columns = [np.asarray(column, dtype="float64") for column in columns]
+    rows = pd.DataFrame({i: column for i, column in enumerate(columns)})
+    inverse = rows.groupby(list(rows.columns), sort=False, dropna=False).ngroup().to_numpy()
+    # first row of every group
+    first = np.empty(inverse.max() + 1, dtype="int64")
+    first[inverse[::-1]] = np.arange(len(inverse))[::-1]
+    weights = np.ones(len(inverse)) if weights is None else np.asarray(weights, dtype="float64")
+    return [column[first] for column in columns], np.bincount(inverse, weights=weights), inverse
+
+
+# Evaluates func(*columns) once per distinct row and broadcasts the result back to every customer.
+# The result is a Series (a DataFrame when func returns one column per row and horizon) with the index of the
+# first column when that is a Series, as with lifetimes.
+def per_distinct_row(func, *columns):
+    unique, _, inverse = compress_rows(*columns)
+    values = np.asarray(func(*unique))[inverse]
+    if isinstance(columns[0], pd.Series):
+        if values.ndim == 2:
+            return pd.DataFrame(values, index=columns[0].index)
+        return pd.Series(values, index=columns[0].index)
+    return values
+
+
+# Minimizes objective(log_params) -> (value, gradient, Hessian) with scipy's trust-region Newton method
+# (trust-exact). The Hessian comes with the value, so it is cached for the optimizer's separate hess call.
+#
+# Warm start: for a refit on almost the same customers, warm_x0 (the previous optimum) starts the search next to
+# the new optimum. The previous Hessian, if given, sizes the first trust region to the Newton step it predicts,
+# so the optimizer does not first try the default radius of 1. If the warm start does not converge the fit is
+# repeated from the cold start x0; a failing cold start raises RuntimeError.
+# Returns the scipy result, the Hessian at the optimum and a Series of convergence diagnostics.
+def _minimize_log_params(objective, x0, tol, max_iter, model_name, warm_x0=None, warm_hessian=None):
+    cache = {}
+
+    def value_and_gradient(log_params):
+        value, gradient, hessian = objective(log_params)
+        cache["x"], cache["hessian"] = log_params.copy(), hessian
+        return value, gradient
+
+    def hessian_of(log_params):
+        if "x" not in cache or not np.array_equal(cache["x"], log_params):
+            value_and_gradient(log_params)
+        return cache["hessian"]
+
+    def run(start, trust_radius=1.0):
+        return minimize(value_and_gradient, start, jac=True, hess=hessian_of, method="trust-exact", tol=tol,
+                        options={"maxiter": max_iter, "initial_trust_radius": trust_radius})
+
+    iterations = 0
+    start = "cold"
+    result = None
+    if warm_x0 is not None:
+        try:
+            with np.errstate(all="ignore"):
+                trust_radius = 1.0
+                if warm_hessian is not None:
+                    _, gradient = value_and_gradient(warm_x0)
+                    newton_step = np.linalg.lstsq(warm_hessian, gradient, rcond=None)[0]
+                    if np.all(np.isfinite(newton_step)):
+                        trust_radius = float(np.clip(np.linalg.norm(newton_step), 1e-3, 1.0))
+                result = run(warm_x0, trust_radius)
+            iterations += result.nit
+        except (ValueError, np.linalg.LinAlgError):
+            # e.g. the previous parameters give a non-finite likelihood on the new data
+            result = None
+        start = "warm" if result is not None and result.success else "cold (warm start failed)"
+    if result is None or not result.success:
+        result = run(x0)
+        iterations += result.nit
+    if not result.success:
+        raise RuntimeError(f"{model_name} fit did not converge: {result.message} "
+                           "Try adding a larger penalizer_coef.")
+
+    hessian = hessian_of(result.x)
+    diagnostics = pd.Series({"start": start,
+                             "iterations": iterations,
+                             "function_evaluations": result.nfev,
+                             "objective": result.fun,
+                             "gradient_norm": float(np.linalg.norm(result.jac)),
+                             "message": result.message})
+    return result, hessian, diagnostics
+
+
+# Shared by the models: saving / loading the fitted parameters and Hessian as json (like Winsorizer),
+# so that tomorrow's refit can be warm-started from today's fit.
+class _SavedModelMixin:
+    def save(self, path):
+        state = {"penalizer_coef": self.penalizer_coef,
+                 "params": self.params_.to_dict(),
+                 "hessian": self.hessian_.tolist()}
+        with open(path, "w") as file:
+            json.dump(state, file, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as file:
+            state = json.load(file)
+        model = cls(state["penalizer_coef"])
+        model.params_ = pd.Series(state["params"])
+        model.hessian_ = np.array(state["hessian"])
+        return model
+
+
+####################### #############
+# BG-NBD Likelihood
+####################### #############
+
+# Weighted BG-NBD log-likelihood (Fader, Hardie & Lee 2005, "Counting Your Customers the Easy Way")
+# with its analytic gradient and Hessian with respect to (r, alpha, a, b).
+# Per customer the likelihood is  exp(A1 + A2) * (exp(A3) + [x > 0] exp(A4))
+#   A1 = ln G(r + x) - ln G(r) + r ln(alpha)
+#   A2 = ln G(a + b) + ln G(b + x) - ln G(b) - ln G(a + b + x)
+#   A3 = -(r + x) ln(alpha + T)
+#   A4 = ln(a) - ln(b + x - 1) - (r + x) ln(alpha + t_x)
+# and the last factor is evaluated as a log-sum-exp. Its derivatives are the p3 / p4 weighted derivatives of
+# A3 / A4 (p3 + p4 = 1), plus p3 * p4 * (g3 - g4)(g3 - g4)^T in the Hessian.
+# The gamma-function terms only depend on the integer frequency, so they are evaluated once per distinct
+# frequency with the summed weights; only the A3 / A4 part runs over every customer.
+# Returns (log-likelihood sum, gradient (4,), Hessian (4, 4)).
+def bgnbd_log_likelihood(params, frequency, recency, T, weights):
+    r, alpha, a, b = params
+    x = frequency
+    # as in lifetimes, customers without repeat purchases use b instead of b - 1 (their A4 term drops out)
+    b_x = b + np.maximum(x, 1) - 1
+
+    # A1 + A2 per distinct frequency (r ln(alpha) is added with the total weight)
+    unique_x, inverse = np.unique(x, return_inverse=True)
+    weights_x = np.bincount(inverse, weights=weights)
+    total = weights_x.sum()
+    A12 = gammaln(r + unique_x) - gammaln(r) + gammaln(a + b) + gammaln(b + unique_x) - gammaln(b) \
+        - gammaln(a + b + unique_x)
+
+    A3 = -(r + x) * np.log(alpha + T)
+    with np.errstate(divide="ignore"):
+        A4 = np.where(x > 0, np.log(a) - np.log(b_x) - (r + x) * np.log(alpha + recency), -np.inf)
+    A_max = np.maximum(A3, A4)
+    log_sum = A_max + np.log(np.exp(A3 - A_max) + np.exp(A4 - A_max))
+    p3 = np.exp(A3 - log_sum)
+    p4 = 1 - p3
+
+    # gradient: A1 + A2 part, then the p3 / p4 weighted derivatives of A3 and A4
+    gradient = np.array([weights_x @ (psi(r + unique_x) - psi(r)) + total * np.log(alpha),
+                         total * r / alpha,
+                         weights_x @ (psi(a + b) - psi(a + b + unique_x)),
+                         weights_x @ (psi(a + b) + psi(b + unique_x) - psi(b) - psi(a + b + unique_x))])
+    n = len(x)
+    g3 = np.column_stack([-np.log(alpha + T), -(r + x) / (alpha + T), np.zeros(n), np.zeros(n)])
+    g4 = np.column_stack([-np.log(alpha + recency), -(r + x) / (alpha + recency), np.full(n, 1 / a), -1 / b_x])
+    gradient += (weights * p3) @ g3 + (weights * p4) @ g4
+
+    trigamma = lambda value: polygamma(1, value)
+    hessian = np.zeros((4, 4))
+    hessian[0, 0] = weights_x @ (trigamma(r + unique_x) - trigamma(r))
+    hessian[0, 1] = total / alpha - weights @ (p3 / (alpha + T) + p4 / (alpha + recency))
+    hessian[1, 1] = -total * r / alpha ** 2 + weights @ (p3 * (r + x) / (alpha + T) ** 2
+                                                          + p4 * (r + x) / (alpha + recency) ** 2)
+    hessian[2, 3] = weights_x @ (trigamma(a + b) - trigamma(a + b + unique_x))
+    hessian[2, 2] = hessian[2, 3] - weights @ p4 / a ** 2
+    hessian[3, 3] = weights_x @ (trigamma(a + b) + trigamma(b + unique_x) - trigamma(b) - trigamma(a + b + unique_x)) \
+        + weights @ (p4 / b_x ** 2)
+    hessian = np.triu(hessian) + np.triu(hessian, 1).T
+    difference = g3 - g4
+    hessian += (difference * (weights * p3 * p4)[:, None]).T @ difference
+
+    return weights_x @ A12 + total * r * np.log(alpha) + weights @ log_sum, gradient, hessian
+
+
+####################### #############
+# BG-NBD Model
+####################### #############
+
+# Drop-in replacement of lifetimes.BetaGeoFitter for the calls of the CLTV scripts.
+# The objective is the one of lifetimes: the mean negative log-likelihood (time scaled so that max(T) = 1)
+# plus penalizer_coef * sum(params ** 2), optimized over the log parameters. Instead of numerical
+# (autograd) derivatives it uses the analytic gradient and Hessian of bgnbd_log_likelihood with a
+# trust-region Newton method, so one iteration is a few vectorized passes over the customers.
+class BetaGeoModel(_SavedModelMixin):
+    def __init__(self, penalizer_coef=0.0):
+        self.penalizer_coef = penalizer_coef
+        self.params_ = None
+
+    # Objective, gradient and Hessian in log-parameter space.
+    def _objective(self, log_params, frequency, recency, T, weights):
+        params = np.exp(log_params)
+        log_likelihood, gradient, hessian = bgnbd_log_likelihood(params, frequency, recency, T, weights)
+        total = weights.sum()
+        value = -log_likelihood / total + self.penalizer_coef * np.sum(params ** 2)
+        gradient = -gradient / total + 2 * self.penalizer_coef * params
+        hessian = -hessian / total + 2 * self.penalizer_coef * np.eye(4)
+        # chain rule for params = exp(log_params)
+        hessian = params[:, None] * hessian * params[None, :] + np.diag(params * gradient)
+        return value, params * gradient, hessian
+
+    # compress=True fits on the distinct (frequency, recency, T) tuples with their counts as weights.
+    # warm_start: a fitted BetaGeoModel (e.g. yesterday's, from BetaGeoModel.load) to start from, see
+    # _minimize_log_params. diagnostics_ tells how the fit started and how many iterations it took.
+    def fit(self, frequency, recency, T, weights=None, initial_params=None, tol=1e-7, max_iter=200, compress=True,
+            warm_start=None):
+        frequency = np.asarray(frequency, dtype="float64")
+        recency = np.asarray(recency, dtype="float64")
+        T = np.asarray(T, dtype="float64")
+        if np.any(recency > T) or np.any(recency < 0):
+            raise ValueError("recency must be between 0 and T.")
+        if np.any(recency[frequency == 0] != 0):
+            raise ValueError("There exist non-zero recency values when frequency is zero.")
+        if compress:
+            (frequency, recency, T), weights, _ = compress_rows(frequency, recency, T, weights=weights)
+        weights = np.ones_like(T) if weights is None else np.asarray(weights, dtype="float64")
+
+        scale = 1.0 / T.max()
+        args = (frequency, recency * scale, T * scale, weights)
+        x0 = np.full(4, np.log(0.1)) if initial_params is None else np.asarray(initial_params, dtype="float64")
+        warm_x0 = warm_hessian = None
+        if warm_start is not None:
+            # the optimizer works on alpha in scaled time
+            warm_x0 = np.log(warm_start.params_[BGNBD_PARAMS].to_numpy(dtype="float64") * [1, scale, 1, 1])
+            warm_hessian = getattr(warm_start, "hessian_", None)
+        result, hessian, diagnostics = _minimize_log_params(
+            lambda log_params: self._objective(log_params, *args), x0, tol, max_iter, "BG-NBD", warm_x0, warm_hessian)
+
+        params = np.exp(result.x)
+        params[1] /= scale
+        self.params_ = pd.Series(params, index=BGNBD_PARAMS)
+        self.negative_log_likelihood_ = result.fun
+        self.hessian_ = hessian
+        self.n_iterations_ = diagnostics["iterations"]
+        self.diagnostics_ = diagnostics
+        return self
+
+    def _unload_params(self, *names):
+        if self.params_ is None:
+            raise ValueError("BetaGeoModel is not fitted yet, call fit() first.")
+        return [self.params_[name] for name in names]
+
+    # Expected number of repeat purchases in the next t periods (equation 10 of Fader, Hardie & Lee 2005),
+    # the same formula as lifetimes including its fallback for an overflowing hypergeometric term.
+    # The hypergeometric function is evaluated once per distinct (frequency, recency, T).
+    def conditional_expected_number_of_purchases_up_to_time(self, t, frequency, recency, T):
+        if np.ndim(frequency) == 0:
+            return self._expected_purchases(t, frequency, recency, T)
+        return per_distinct_row(lambda x, t_x, age: self._expected_purchases(t, x, t_x, age), frequency, recency, T)
+
+    # Expected purchases for several horizons at once, e.g. predict_horizons([1, 4, 12], ...) for one week,
+    # one month and three months: a customers x horizons frame with the horizons as columns.
+    # The terms that do not depend on the horizon (the first term and the denominator of equation 10, and
+    # the grouping into distinct rows) are computed once; each extra horizon only adds its hypergeometric term.
+    def predict_horizons(self, horizons, frequency, recency, T):
+        t = np.asarray(horizons, dtype="float64")[None, :]
+        expected = per_distinct_row(
+            lambda x, t_x, age: self._expected_purchases(t, x[:, None], t_x[:, None], age[:, None]),
+            frequency, recency, T)
+        if isinstance(expected, pd.DataFrame):
+            expected.columns = list(horizons)
+        return expected
+
+    # Equation 10; with column-shaped customer arrays and a row of horizons it returns a customers x horizons array.
+    def _expected_purchases(self, t, frequency, recency, T):
+        x = frequency
+        r, alpha, a, b = self._unload_params("r", "alpha", "a", "b")
+
+        _a = r + x
+        _b = b + x
+        _c = a + b + x - 1
+        _z = t / (alpha + T + t)
+        with np.errstate(divide="ignore"):
+            ln_hyp_term = np.log(hyp2f1(_a, _b, _c, _z))
+            ln_hyp_term_alt = np.log(hyp2f1(_c - _a, _c - _b, _c, _z)) + (_c - _a - _b) * np.log(1 - _z)
+        ln_hyp_term = np.where(np.isinf(ln_hyp_term), ln_hyp_term_alt, ln_hyp_term)
+        first_term = (a + b + x - 1) / (a - 1)
+        second_term = 1 - np.exp(ln_hyp_term + (r + x) * np.log((alpha + T) / (alpha + t + T)))
+
+        numerator = first_term * second_term
+        denominator = 1 + (x > 0) * (a / (b + x - 1)) * ((alpha + T) / (alpha + recency)) ** (r + x)
+        return numerator / denominator
+
+    def predict(self, t, frequency, recency, T):
+        return self.conditional_expected_number_of_purchases_up_to_time(t, frequency, recency, T)
+
+    # Probability that a customer with this history is still alive (equation 13 of the BG-NBD note).
+    def conditional_probability_alive(self, frequency, recency, T):
+        r, alpha, a, b = self._unload_params("r", "alpha", "a", "b")
+        log_div = (r + frequency) * np.log((alpha + T) / (alpha + recency)) + np.log(
+            a / (b + np.maximum(frequency, 1) - 1))
+        return np.atleast_1d(np.where(frequency == 0, 1.0, 1.0 / (1 + np.exp(log_div))))
+
+
+####################### #############
+# Gamma-Gamma Model
+####################### #############
+
+# Weighted Gamma-Gamma log-likelihood (Fader, Hardie & Lee 2005, "RFM and CLV: Using Iso-value Curves")
+# of the average transaction value m of customers with x repeat purchases, with its analytic gradient and
+# Hessian with respect to (p, q, v):
+#   ll = ln G(px + q) - ln G(px) - ln G(q) + q ln(v) + (px - 1) ln(m) + px ln(x) - (px + q) ln(xm + v)
+# The digamma / trigamma terms only depend on x and are evaluated once per distinct frequency.
+# Returns (log-likelihood sum, gradient (3,), Hessian (3, 3)).
+def gamma_gamma_log_likelihood(params, frequency, monetary, weights):
+    p, q, v = params
+    x, m = frequency, monetary
+    unique_x, inverse = np.unique(x, return_inverse=True)
+    weights_x = np.bincount(inverse, weights=weights)
+    total = weights_x.sum()
+    xm_v = x * m + v
+
+    log_likelihood = weights_x @ (gammaln(p * unique_x + q) - gammaln(p * unique_x)) - total * gammaln(q) \
+        + total * q * np.log(v) + weights @ ((p * x - 1) * np.log(m) + p * x * np.log(x) - (p * x + q) * np.log(xm_v))
+
+    psi_pxq, psi_px = psi(p * unique_x + q), psi(p * unique_x)
+    gradient = np.array([weights_x @ (unique_x * (psi_pxq - psi_px)) + weights @ (x * np.log(x * m / xm_v)),
+                         weights_x @ psi_pxq - total * psi(q) + total * np.log(v) - weights @ np.log(xm_v),
+                         total * q / v - weights @ ((p * x + q) / xm_v)])
+
+    trigamma_pxq, trigamma_px = polygamma(1, p * unique_x + q), polygamma(1, p * unique_x)
+    hessian = np.zeros((3, 3))
+    hessian[0, 0] = weights_x @ (unique_x ** 2 * (trigamma_pxq - trigamma_px))
+    hessian[0, 1] = weights_x @ (unique_x * trigamma_pxq)
+    hessian[0, 2] = -weights @ (x / xm_v)
+    hessian[1, 1] = weights_x @ trigamma_pxq - total * polygamma(1, q)
+    hessian[1, 2] = total / v - weights @ (1 / xm_v)
+    hessian[2, 2] = -total * q / v ** 2 + weights @ ((p * x + q) / xm_v ** 2)
+    hessian = np.triu(hessian) + np.triu(hessian, 1).T
+    return log_likelihood, gradient, hessian
+
+
+# Drop-in replacement of lifetimes.GammaGammaFitter for the calls of the CLTV scripts, with the objective of
+# lifetimes (mean negative log-likelihood + penalizer_coef * sum(params ** 2), over the log parameters).
+class GammaGammaModel(_SavedModelMixin):
+    def __init__(self, penalizer_coef=0.0):
+        self.penalizer_coef = penalizer_coef
+        self.params_ = None
+
+    def _objective(self, log_params, frequency, monetary, weights):
+        params = np.exp(log_params)
+        log_likelihood, gradient, hessian = gamma_gamma_log_likelihood(params, frequency, monetary, weights)
+        total = weights.sum()
+        value = -log_likelihood / total + self.penalizer_coef * np.sum(params ** 2)
+        gradient = -gradient / total + 2 * self.penalizer_coef * params
+        hessian = -hessian / total + 2 * self.penalizer_coef * np.eye(3)
+        hessian = params[:, None] * hessian * params[None, :] + np.diag(params * gradient)
+        return value, params * gradient, hessian
+
+    # compress=True fits on the distinct (frequency, monetary) pairs with their counts as weights.
+    # warm_start: a fitted GammaGammaModel to start from, as in BetaGeoModel.fit.
+    def fit(self, frequency, monetary_value, weights=None, initial_params=None, tol=1e-7, max_iter=200,
+            compress=True, warm_start=None):
+        frequency = np.asarray(frequency, dtype="float64")
+        monetary_value = np.asarray(monetary_value, dtype="float64")
+        if np.any(frequency <= 0) or np.any(monetary_value <= 0):
+            raise ValueError("Gamma-Gamma needs customers with frequency > 0 and monetary_value > 0.")
+        if compress:
+            (frequency, monetary_value), weights, _ = compress_rows(frequency, monetary_value, weights=weights)
+        weights = np.ones_like(frequency) if weights is None else np.asarray(weights, dtype="float64")
+
+        x0 = np.full(3, np.log(0.1)) if initial_params is None else np.asarray(initial_params, dtype="float64")
+        warm_x0 = warm_hessian = None
+        if warm_start is not None:
+            warm_x0 = np.log(warm_start.params_[GAMMA_GAMMA_PARAMS].to_numpy(dtype="float64"))
+            warm_hessian = getattr(warm_start, "hessian_", None)
+        result, hessian, diagnostics = _minimize_log_params(
+            lambda log_params: self._objective(log_params, frequency, monetary_value, weights),
+            x0, tol, max_iter, "Gamma-Gamma", warm_x0, warm_hessian)
+
+        self.params_ = pd.Series(np.exp(result.x), index=GAMMA_GAMMA_PARAMS)
+        self.negative_log_likelihood_ = result.fun
+        self.hessian_ = hessian
+        self.n_iterations_ = diagnostics["iterations"]
+        self.diagnostics_ = diagnostics
+        return self
+
+    def _unload_params(self, *names):
+        if self.params_ is None:
+            raise ValueError("GammaGammaModel is not fitted yet, call fit() first.")
+        return [self.params_[name] for name in names]
+
+    # Weighted average of the customer's own average value and the population mean.
+    def conditional_expected_average_profit(self, frequency, monetary_value):
+        p, q, v = self._unload_params("p", "q", "v")
+        individual_weight = p * frequency / (p * frequency + q - 1)
+        population_mean = v * p / (q - 1)
+        return (1 - individual_weight) * population_mean + individual_weight * monetary_value
+
+    # Discounted CLV over `time` months as in lifetimes: the monthly expected purchases of transaction_model
+    # (BetaGeoModel or BetaGeoFitter) times the expected average profit. freq is the time unit of recency / T.
+    # Evaluated once per distinct (frequency, recency, T, monetary_value) and broadcast back.
+    def customer_lifetime_value(self, transaction_model, frequency, recency, T, monetary_value, time=12,
+                                discount_rate=0.01, freq="D"):
+        factor = {"W": 4.345, "M": 1.0, "D": 30, "H": 30 * 24}[freq]
+        steps = np.arange(1, time + 1) * factor
+        discount = (1 + discount_rate) ** (steps / factor)
+
+        def clv(x, t_x, age, m):
+            adjusted_monetary_value = self.conditional_expected_average_profit(x, m)
+            if hasattr(transaction_model, "predict_horizons"):
+                # all month ends in one call; the predictions are cumulative, so each month is a difference
+                cumulative = transaction_model.predict_horizons(np.concatenate([[0], steps]), x, t_x, age)
+                expected_number_of_transactions = np.diff(cumulative, axis=1)
+                return adjusted_monetary_value * (expected_number_of_transactions / discount).sum(axis=1)
+            total = np.zeros(len(x))
+            for i, month_discount in zip(steps, discount):
+                expected_number_of_transactions = transaction_model.predict(i, x, t_x, age) \
+                    - transaction_model.predict(i - factor, x, t_x, age)
+                total += adjusted_monetary_value * expected_number_of_transactions / month_discount
+            return total
+
+        values = per_distinct_row(clv, frequency, recency, T, monetary_value)
+        if isinstance(values, pd.Series):
+            values.name = "clv"
+        return values
+
+
+####################### #############
+# Model Cache
+####################### #############
+
+# Keeps fitted models and prediction columns on disk under a fingerprint of the customer summary frame:
+#   cache_dir/<fingerprint>/bgnbd.json            BetaGeoModel.save
+#   cache_dir/<fingerprint>/gamma_gamma.json      GammaGammaModel.save
+#   cache_dir/<fingerprint>/predictions.parquet   prediction columns, indexed like the summary frame
+# A later create_cltv_p on the same customers (another month or number of segments) loads the models instead of
+# fitting them, and reads the columns it computed before instead of predicting them again.
+# When the folder grows past max_bytes, the least recently used entries are removed.
+# cache_dir=None turns the cache off: everything is computed and nothing is written.
+
+# Bump this when the models or the stored columns change, so that entries of an older version are not re-used.
+MODEL_CACHE_VERSION = "1"
+PREDICTIONS_FILE = "predictions.parquet"
+
+
+class ModelCache:
+    def __init__(self, cache_dir, max_bytes=256 * 1024 ** 2):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    # Content fingerprint: one vectorized 64-bit hash per row (index included), then a sha1 over the row hashes,
+    # the column names and the settings (e.g. the penalizers). A summary of a million customers hashes in well
+    # under a second, compared to seconds for the fits it replaces.
+    def fingerprint(self, summary, **settings):
+        digest = hashlib.sha1(MODEL_CACHE_VERSION.encode("utf-8"))
+        digest.update(pd.util.hash_pandas_object(summary, index=True).to_numpy().tobytes())
+        digest.update(repr((list(summary.columns), sorted(settings.items()))).encode("utf-8"))
+        return digest.hexdigest()[:16]
+
+    # classes maps file names to model classes, e.g. {"bgnbd": BetaGeoModel, "gamma_gamma": GammaGammaModel}.
+    # Returns the stored models in that order, or calls fit() (which returns them in that order) and stores them.
+    def models(self, key, classes, fit):
+        if self.cache_dir is None:
+            return fit()
+        entry_dir = os.path.join(self.cache_dir, key)
+        files = [os.path.join(entry_dir, name + ".json") for name in classes]
+        if all(os.path.exists(file) for file in files):
+            os.utime(entry_dir)
+            return tuple(model_class.load(file) for model_class, file in zip(classes.values(), files))
+
+        models = fit()
+        os.makedirs(entry_dir, exist_ok=True)
+        for model, file in zip(models, files):
+            # Write to a temporary file first so that an interrupted run never leaves half an entry behind.
+            model.save(file + ".tmp")
+            os.replace(file + ".tmp", file)
+        self._evict(key)
+        return models
+
+    # Returns the columns `names` of the entry. If one of them is not stored yet, compute() is called; it returns a
+    # DataFrame with (at least) these columns, indexed like the summary frame, which is added to the stored columns.
+    def columns(self, key, names, compute):
+        if self.cache_dir is None:
+            return compute()[names]
+        entry_dir = os.path.join(self.cache_dir, key)
+        file = os.path.join(entry_dir, PREDICTIONS_FILE)
+        stored = pd.read_parquet(file) if os.path.exists(file) else None
+        if stored is not None and all(name in stored.columns for name in names):
+            os.utime(entry_dir)
+            return stored[names]
+
+        computed = compute()[names]
+        if stored is not None:
+            computed = stored.drop(columns=names, errors="ignore").join(computed)
+        os.makedirs(entry_dir, exist_ok=True)
+        computed.to_parquet(file + ".tmp")
+        os.replace(file + ".tmp", file)
+        self._evict(key)
+        return computed[names]
+
+    # Total size of the cache in bytes.
+    def size(self):
+        return sum(size for _, _, size in self._entries())
+
+    # (last use, key, bytes) of every entry. Reading an entry touches its folder, writing a file changes it.
+    def _entries(self):
+        if not os.path.isdir(self.cache_dir):
+            return []
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, key)
+            if os.path.isdir(entry_dir):
+                size = sum(os.path.getsize(os.path.join(entry_dir, name)) for name in os.listdir(entry_dir))
+                entries.append((os.path.getmtime(entry_dir), key, size))
+        return entries
+
+    # Removes the least recently used entries until the cache fits in max_bytes. The entry that was just written
+    # (keep) is never removed, even if it alone is larger than max_bytes.
+    def _evict(self, keep):
+        entries = self._entries()
+        total = sum(size for _, _, size in entries)
+        for _, key, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key != keep:
+                shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+                total -= size
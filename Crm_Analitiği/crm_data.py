@@ -0,0 +1,305 @@
+####################### #############
+# Data Loading Helpers
+####################### #############
+
+# Shared readers for the Online Retail II workbook and the FLO customer file.
+# The analysis scripts import from here instead of calling pd.read_excel / pd.read_csv directly.
+
+import hashlib
+import multiprocessing as mp
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+####################### #############
+# Online Retail II
+####################### #############
+
+# Column types of the Online Retail II sheets after they come out of openpyxl.
+# Invoice and StockCode mix numbers and letters ("C489449", "85123A"), so they are kept as strings.
+ONLINE_RETAIL_DTYPES = {"Invoice": "string",
+                        "StockCode": "string",
+                        "Description": "string",
+                        "Quantity": "int64",
+                        "Price": "float64",
+                        "Customer ID": "float64",
+                        "Country": "string"}
+
+
+# Bump this when the cached columns change, so that caches written by an older version are not re-used.
+CACHE_VERSION = "2"
+
+
+# The cache file name is built from the workbook path, its modification time and the sheet name.
+# If the workbook is replaced or edited, the mtime changes and a new cache file is written.
+def _cache_path(path, sheet_name, cache_dir):
+    path = os.path.abspath(path)
+    key = "|".join([path, str(os.stat(path).st_mtime_ns), str(sheet_name), CACHE_VERSION])
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(path), ".cache")
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(cache_dir, f"{stem}-{digest}.parquet")
+
+
+# Give the sheet a stable schema so that Parquet can store it column by column.
+def _apply_online_retail_dtypes(dataframe):
+    dataframe = dataframe.astype({col: dtype for col, dtype in ONLINE_RETAIL_DTYPES.items()
+                                  if col in dataframe.columns})
+    dataframe["InvoiceDate"] = pd.to_datetime(dataframe["InvoiceDate"])
+    return encode_invoices(dataframe)
+
+
+# Splits the Invoice string into an integer invoice number and a cancellation flag.
+# "C489449" -> InvoiceNo=489449, is_cancelled=True ; "489450" -> InvoiceNo=489450, is_cancelled=False
+# The string scan runs once at load time (and is stored in the cache), so the scripts can filter
+# cancellations with df[~df["is_cancelled"]] and count invoices on integers instead of strings.
+def encode_invoices(dataframe):
+    invoice = dataframe["Invoice"].astype("string")
+    dataframe["is_cancelled"] = invoice.str.startswith("C").fillna(False).astype(bool)
+    dataframe["InvoiceNo"] = pd.to_numeric(invoice.str.replace(r"^\D+", "", regex=True)).astype("int32")
+    return dataframe
+
+
+# Day numbers (days since 1970-01-01) are used for InvoiceDate in compact mode.
+EPOCH = pd.Timestamp("1970-01-01")
+
+
+# Turns a date into its day number. Integers are taken as day numbers already.
+def to_day_number(date):
+    if isinstance(date, (int, np.integer)):
+        return int(date)
+    return (pd.Timestamp(date) - EPOCH).days
+
+
+# Shrinks a transaction frame to the smallest types that still hold the Online Retail data:
+# Customer ID -> Int32 (nullable, missing ids stay missing), Quantity -> int32, Price -> float32,
+# text columns -> category and InvoiceDate -> int32 day number.
+# compute_customer_aggregates understands integer day numbers, so the create_* functions work unchanged.
+# Because the time of day is dropped, day differences can move by one day compared to the full timestamps.
+def compact_transactions(dataframe):
+    dataframe = dataframe.astype({"Customer ID": "Int32",
+                                  "Quantity": "int32",
+                                  "Price": "float32",
+                                  "Invoice": "category",
+                                  "StockCode": "category",
+                                  "Description": "category",
+                                  "Country": "category"})
+    if pd.api.types.is_datetime64_any_dtype(dataframe["InvoiceDate"]):
+        dataframe["InvoiceDate"] = ((dataframe["InvoiceDate"] - EPOCH).dt.days).astype("int32")
+    return dataframe
+
+
+# Reads one sheet of the Online Retail II workbook.
+# The first call parses the xlsx with openpyxl and writes a Parquet copy next to the workbook (datasets/.cache).
+# Later calls read the Parquet copy, which takes well under a second instead of minutes.
+# use_cache=False always parses the workbook (the result still has the typed columns).
+# compact=True returns the frame with the compact types of compact_transactions.
+def load_online_retail(path, sheet_name="Year 2010-2011", cache_dir=None, use_cache=True, compact=False):
+    dataframe = _load_online_retail_sheet(path, sheet_name, cache_dir, use_cache)
+    if compact:
+        dataframe = compact_transactions(dataframe)
+    return dataframe
+
+
+def _load_online_retail_sheet(path, sheet_name, cache_dir, use_cache):
+    cache_file = _cache_path(path, sheet_name, cache_dir)
+    if use_cache and os.path.exists(cache_file):
+        return pd.read_parquet(cache_file)
+
+    dataframe = _apply_online_retail_dtypes(pd.read_excel(path, sheet_name=sheet_name))
+
+    if use_cache:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        # Write to a temporary file first so that an interrupted run never leaves half a cache behind.
+        tmp_file = cache_file + ".tmp"
+        dataframe.to_parquet(tmp_file, index=False)
+        os.replace(tmp_file, cache_file)
+
+    return dataframe
+
+
+# Reads one source of load_transactions, by file suffix: a csv export with the Online Retail II columns
+# (e.g. a monthly export), a Parquet file (e.g. a part of the month store of crm_store.py), or otherwise
+# a sheet of an Excel workbook, read through the Parquet cache of load_online_retail.
+def _load_transaction_source(path, sheet_name, cache_dir, use_cache):
+    suffix = os.path.splitext(path)[1].lower()
+    if suffix == ".csv":
+        return _apply_online_retail_dtypes(pd.read_csv(path, dtype=ONLINE_RETAIL_DTYPES))
+    if suffix == ".parquet":
+        return pd.read_parquet(path)
+    return _load_online_retail_sheet(path, sheet_name, cache_dir, use_cache)
+
+
+# Loads several sheets (or several files) into one transaction frame.
+# sources is a list of (path, sheet_name) pairs, e.g.
+#   [(DATA_PATH, "Year 2009-2010"), (DATA_PATH, "Year 2010-2011")]
+# or of plain paths (str or pathlib.Path) for files that hold a single sheet, like monthly xlsx / csv exports.
+# Each source is parsed (or read from its cache) in its own worker process, so the total time is about
+# the time of the slowest source instead of the sum. A single source (or max_workers=1) is read in this process.
+# With the spawn start method (Windows, macOS) every worker re-imports the __main__ module, which re-runs the
+# top-level code of a script that has no if __name__ == "__main__": guard. max_workers=None therefore only
+# starts workers under fork (Linux) and otherwise reads the sources one after another in this process;
+# pass max_workers > 1 explicitly from a guarded script to read them in parallel there too.
+# The Online Retail II sheets overlap in December 2010; an invoice that was already read from an earlier source
+# is skipped in the later ones.
+def load_transactions(sources, max_workers=None, cache_dir=None, use_cache=True, compact=False):
+    sources = [(source, 0) if isinstance(source, (str, os.PathLike)) else tuple(source) for source in sources]
+    if max_workers is None and mp.get_start_method() != "fork":
+        max_workers = 1
+    if len(sources) == 1 or max_workers == 1:
+        frames = [_load_transaction_source(path, sheet_name, cache_dir, use_cache) for path, sheet_name in sources]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_load_transaction_source, path, sheet_name, cache_dir, use_cache)
+                       for path, sheet_name in sources]
+            frames = [future.result() for future in futures]
+
+    seen_invoices = frames[0]["Invoice"].unique()
+    for i in range(1, len(frames)):
+        frames[i] = frames[i][~frames[i]["Invoice"].isin(seen_invoices)]
+        seen_invoices = pd.concat([pd.Series(seen_invoices), frames[i]["Invoice"]]).unique()
+
+    dataframe = pd.concat(frames, ignore_index=True)
+    if compact:
+        dataframe = compact_transactions(dataframe)
+    return dataframe
+
+
+# Reads transactions piece by piece, for archives that do not fit in memory.
+# source can be a csv export with the Online Retail II columns, or a folder of Parquet files
+# (e.g. the month store of crm_store.py). Every chunk gets the typed columns and the invoice encoding.
+# Both kinds of source yield at most chunksize rows at a time; a Parquet file is read in record batches,
+# so one large file (a big month part) is never loaded whole.
+def iter_transaction_chunks(source, chunksize=500_000):
+    if os.path.isdir(source):
+        for root, _, file_names in sorted(os.walk(source)):
+            for file_name in sorted(file_names):
+                if file_name.endswith(".parquet"):
+                    parquet_file = pq.ParquetFile(os.path.join(root, file_name))
+                    for batch in parquet_file.iter_batches(batch_size=chunksize):
+                        yield batch.to_pandas()
+        return
+    for chunk in pd.read_csv(source, dtype=ONLINE_RETAIL_DTYPES, chunksize=chunksize):
+        yield _apply_online_retail_dtypes(chunk)
+
+
+####################### #############
+# FLO Customer Data
+####################### #############
+
+FLO_DATE_FORMAT = "%Y-%m-%d"
+
+FLO_DATE_COLUMNS = ["first_order_date",
+                    "last_order_date",
+                    "last_order_date_online",
+                    "last_order_date_offline"]
+
+# The channel categories are fixed, so every chunk gets the same categories and chunks can be concatenated.
+# Other collects channel names that are not in this list (a new channel in a later export).
+FLO_CHANNELS = pd.CategoricalDtype(["Android App", "Desktop", "Ios App", "Mobile", "Offline", "Other"])
+
+FLO_CHANNEL_COLUMNS = ["order_channel", "last_order_channel"]
+
+# Declared schema of flo_data_20k.csv. Order counts and money columns fit comfortably in float32.
+# The channels are read as plain categories and set to FLO_CHANNELS afterwards (see _parse_flo_channel).
+FLO_DTYPES = {"master_id": "string",
+              "order_channel": "category",
+              "last_order_channel": "category",
+              "order_num_total_ever_online": "float32",
+              "order_num_total_ever_offline": "float32",
+              "customer_value_total_ever_offline": "float32",
+              "customer_value_total_ever_online": "float32",
+              "interested_in_categories_12": "string"}
+
+
+# One bit per category of interested_in_categories_12 (KADIN: women, ERKEK: men, COCUK: children).
+# OTHER collects category names that are not in this list (a new category in a later export).
+# category_mask is a uint8 column, so there is room for at most 8 categories.
+FLO_CATEGORIES = {"KADIN": 1,
+                  "ERKEK": 2,
+                  "COCUK": 4,
+                  "AKTIFSPOR": 8,
+                  "AKTIFCOCUK": 16,
+                  "OTHER": 32}
+assert len(FLO_CATEGORIES) <= 8, "category_mask is uint8 and holds at most 8 categories"
+
+
+# Dates are parsed with a fixed format, which skips the per-column format inference of pd.to_datetime.
+# The channels get the FLO_CHANNELS categories and interested_in_categories_12 is parsed into category_mask
+# at the same time.
+def _parse_flo_columns(dataframe):
+    for col in FLO_DATE_COLUMNS:
+        dataframe[col] = pd.to_datetime(dataframe[col], format=FLO_DATE_FORMAT)
+    for col in FLO_CHANNEL_COLUMNS:
+        dataframe[col] = _parse_flo_channel(dataframe[col])
+    dataframe["category_mask"] = parse_category_mask(dataframe["interested_in_categories_12"])
+    return dataframe
+
+
+# Casts a channel column read as a plain category to FLO_CHANNELS.
+# Unknown channel names become Other with a warning, instead of the missing values a direct cast to
+# FLO_CHANNELS would give, so those customers stay in the channel audiences (AudienceIndex.from_flo).
+def _parse_flo_channel(channels):
+    unknown = set(channels.cat.categories) - set(FLO_CHANNELS.categories)
+    if unknown:
+        warnings.warn(f"Unknown channels in {channels.name} are counted as Other: {sorted(unknown)}")
+        channels = channels.astype("string").where(~channels.isin(list(unknown)), "Other")
+    return channels.astype(FLO_CHANNELS)
+
+
+# Turns lists like "[ERKEK, COCUK, KADIN]" into an integer bitmask (ERKEK | COCUK | KADIN = 7).
+# The lists are split once and every category name is matched exactly, so "ERKEK" never matches "KADIN" and
+# "COCUK" never matches "AKTIFCOCUK" the way substring searches do. An empty list "[]" gives 0.
+# Unknown category names get the OTHER bit and a warning, so one new category does not stop a chunked load.
+def parse_category_mask(categories):
+    names = categories.reset_index(drop=True).str.strip("[]").str.split(", ").explode()
+    names = names[names.notna() & (names != "")]
+    unknown = set(names.unique()) - set(FLO_CATEGORIES)
+    if unknown:
+        warnings.warn(f"Unknown categories in interested_in_categories_12 are counted as OTHER: {sorted(unknown)}")
+    bits = names.map(FLO_CATEGORIES).fillna(FLO_CATEGORIES["OTHER"]).to_numpy(dtype="uint8")
+    # OR instead of sum: two unknown names of one customer both map to the OTHER bit
+    mask = np.zeros(len(categories), dtype="uint8")
+    np.bitwise_or.at(mask, names.index.to_numpy(), bits)
+    return pd.Series(mask, index=categories.index)
+
+
+# Bitmask of the given category names, e.g. category_bits("ERKEK", "COCUK") -> 6
+def category_bits(*names):
+    bits = 0
+    for name in names:
+        bits |= FLO_CATEGORIES[name]
+    return bits
+
+
+# Vectorized category filter on the category_mask column:
+# any_of: customers interested in at least one of the categories
+# all_of: customers interested in all of the categories
+# none_of: customers interested in none of the categories
+def interested_in(dataframe, any_of=(), all_of=(), none_of=()):
+    mask = dataframe["category_mask"].to_numpy()
+    selected = np.ones(len(mask), dtype=bool)
+    if any_of:
+        selected &= (mask & category_bits(*any_of)) != 0
+    if all_of:
+        bits = category_bits(*all_of)
+        selected &= (mask & bits) == bits
+    if none_of:
+        selected &= (mask & category_bits(*none_of)) == 0
+    return pd.Series(selected, index=dataframe.index)
+
+
+# Reads flo_data_20k.csv (or any file with the same columns) with typed columns and parsed dates.
+# interested_in_categories_12 is also parsed once into the category_mask column (see interested_in).
+# With chunksize the function returns an iterator of typed chunks instead of one dataframe,
+# so files with millions of customers can be processed piece by piece.
+def load_flo_data(path, chunksize=None):
+    dtypes = dict(FLO_DTYPES, **{col: "string" for col in FLO_DATE_COLUMNS})
+    if chunksize is None:
+        return _parse_flo_columns(pd.read_csv(path, dtype=dtypes))
+    return (_parse_flo_columns(chunk) for chunk in pd.read_csv(path, dtype=dtypes, chunksize=chunksize))
@@ -0,0 +1,163 @@
+####################### #############
+# Preprocessing Helpers
+####################### #############
+
+# Transaction cleaning and outlier suppression shared by the RFM / CLTV scripts.
+
+import json
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+
+####################### #############
+# Winsorizer
+####################### #############
+
+# Multi-column version of outlier_thresholds / replace_with_thresholds.
+# fit() computes the 1% and 99% quantiles of all columns with a single quantile call and turns them into
+# limits with the same IQR rule:  up_limit = q3 + 1.5 * (q3 - q1),  low_limit = q1 - 1.5 * (q3 - q1)
+# transform() clips every column against its limits with one np.clip instead of two masked .loc writes.
+# The fitted limits can be saved to a json file and loaded again, so a later batch (e.g. tomorrow's invoices)
+# is clipped with exactly the same limits without recomputing the quantiles.
+#
+# clip_lower=False only suppresses the upper side (as in CustomerLifeTimeValuePrediction.py).
+# round_limits=True works like replace_with_thresholds of the homework scripts, where frequencies must stay integer:
+# values are compared with the exact limits and replaced by the rounded limits, so a value between the exact and
+# the rounded limit is left alone. The fitted (and saved) limits are always the exact ones.
+class Winsorizer:
+    def __init__(self, lower_quantile=0.01, upper_quantile=0.99, iqr_multiplier=1.5,
+                 clip_lower=True, round_limits=False):
+        self.lower_quantile = lower_quantile
+        self.upper_quantile = upper_quantile
+        self.iqr_multiplier = iqr_multiplier
+        self.clip_lower = clip_lower
+        self.round_limits = round_limits
+        self.limits_ = {}
+
+    def fit(self, dataframe, columns):
+        quantiles = dataframe[list(columns)].quantile([self.lower_quantile, self.upper_quantile])
+        quartile1 = quantiles.iloc[0]
+        quartile3 = quantiles.iloc[1]
+        interquantile_range = quartile3 - quartile1
+        up_limit = quartile3 + self.iqr_multiplier * interquantile_range
+        low_limit = quartile1 - self.iqr_multiplier * interquantile_range
+        self.limits_ = {col: (float(low_limit[col]), float(up_limit[col])) for col in quantiles.columns}
+        return self
+
+    # Clips the fitted columns of dataframe in place and returns it.
+    # The column's own array is updated (np.clip / np.putmask with out=) when pandas hands out a writable view and
+    # the replacement values fit its dtype. Otherwise (an integer column with fractional limits becomes float64,
+    # as with the .loc writes, or copy-on-write pandas, whose arrays are read-only) the result is assigned back once.
+    def transform(self, dataframe):
+        if not self.limits_:
+            raise ValueError("Winsorizer is not fitted yet, call fit() or load() first.")
+        for col, (low_limit, up_limit) in self.limits_.items():
+            low_value, up_value = (round(low_limit, 0), round(up_limit, 0)) if self.round_limits \
+                else (low_limit, up_limit)
+            values = dataframe[col].to_numpy()
+            fits_dtype = values.dtype.kind == "f" or (values.dtype.kind in "iu" and float(up_value).is_integer()
+                                                      and (not self.clip_lower or float(low_value).is_integer()))
+            in_place = isinstance(dataframe[col].dtype, np.dtype) and values.flags.writeable and fits_dtype
+            if not in_place:
+                values = values.astype(values.dtype if fits_dtype else "float64")
+
+            if self.round_limits:
+                if self.clip_lower:
+                    np.putmask(values, values < low_limit, low_value)
+                np.putmask(values, values > up_limit, up_value)
+            else:
+                np.clip(values, values.dtype.type(low_value) if self.clip_lower else None,
+                        values.dtype.type(up_value), out=values)
+
+            if not in_place:
+                dataframe[col] = values
+        return dataframe
+
+    def fit_transform(self, dataframe, columns):
+        return self.fit(dataframe, columns).transform(dataframe)
+
+    def save(self, path):
+        state = {"lower_quantile": self.lower_quantile,
+                 "upper_quantile": self.upper_quantile,
+                 "iqr_multiplier": self.iqr_multiplier,
+                 "clip_lower": self.clip_lower,
+                 "round_limits": self.round_limits,
+                 "limits": self.limits_}
+        with open(path, "w") as file:
+            json.dump(state, file, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as file:
+            state = json.load(file)
+        winsorizer = cls(state["lower_quantile"], state["upper_quantile"], state["iqr_multiplier"],
+                         state["clip_lower"], state["round_limits"])
+        winsorizer.limits_ = {col: tuple(limits) for col, limits in state["limits"].items()}
+        return winsorizer
+
+    # The fitted limits as a small dataframe, handy for a quick look in the console.
+    def limits_frame(self):
+        return pd.DataFrame(self.limits_, index=["low_limit", "up_limit"]).T
+
+
+####################### #############
+# Transaction Cleaning
+####################### #############
+
+# The filters the scripts apply before computing RFM / CLTV metrics.
+# Each rule returns a boolean Series that is True for the rows to keep.
+CLEANING_RULES = {"missing": lambda dataframe: dataframe.notna().all(axis=1),
+                  "cancelled": lambda dataframe: ~dataframe["is_cancelled"],
+                  "price": lambda dataframe: dataframe["Price"] > 0,
+                  "quantity": lambda dataframe: dataframe["Quantity"] > 0}
+
+
+# Replaces the dropna(inplace=True) + three chained filters + TotalPrice steps of the scripts.
+# All rules are combined into one mask and the cleaned frame is materialized once (with take, so pandas
+# does not flag it as a copy and no chained_assignment option is needed). The input frame is not modified.
+#
+# rules:      which filters of CLEANING_RULES to apply, in any order
+# winsorizer: optional Winsorizer; an unfitted one is fitted on Quantity and Price of the cleaned rows,
+#             a fitted one (e.g. from Winsorizer.load) only clips. Clipping happens before TotalPrice.
+# report:     also return a Series with the rows removed by each rule, the frame sizes and the peak memory
+#             allocated during cleaning (measured with tracemalloc, so only run it with report=True when needed)
+def clean_transactions(dataframe, rules=("missing", "cancelled", "price", "quantity"), winsorizer=None, report=False):
+    if not report:
+        return _clean_transactions(dataframe, rules, winsorizer)[0]
+
+    # tracing is switched off again even if cleaning fails (unless it was already on before the call)
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    try:
+        cleaned, masks, keep = _clean_transactions(dataframe, rules, winsorizer)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        if not was_tracing:
+            tracemalloc.stop()
+
+    # A row can break several rules, so the per-rule counts can add up to more than total_dropped.
+    cleaning_report = pd.Series({f"dropped_{rule}": int((~mask).sum()) for rule, mask in masks.items()})
+    cleaning_report["total_dropped"] = int((~keep).sum())
+    cleaning_report["rows_kept"] = len(cleaned)
+    cleaning_report["input_memory_mb"] = dataframe.memory_usage(deep=True).sum() / 1024 ** 2
+    cleaning_report["cleaned_memory_mb"] = cleaned.memory_usage(deep=True).sum() / 1024 ** 2
+    cleaning_report["peak_memory_mb"] = peak / 1024 ** 2
+    return cleaned, cleaning_report
+
+
+# Returns the cleaned frame, the keep-mask of every rule and the combined mask.
+def _clean_transactions(dataframe, rules, winsorizer):
+    masks = {rule: CLEANING_RULES[rule](dataframe).to_numpy() for rule in rules}
+    keep = np.logical_and.reduce(list(masks.values())) if masks else np.ones(len(dataframe), dtype=bool)
+    cleaned = dataframe.take(np.flatnonzero(keep))
+
+    if winsorizer is not None:
+        if winsorizer.limits_:
+            winsorizer.transform(cleaned)
+        else:
+            winsorizer.fit_transform(cleaned, ["Quantity", "Price"])
+    cleaned["TotalPrice"] = cleaned["Quantity"] * cleaned["Price"]
+    return cleaned, masks, keep
@@ -0,0 +1,174 @@
+####################### #############
+# Month-Partitioned Transaction Store
+####################### #############
+
+# Keeps the transactions on disk as one folder per InvoiceDate month:
+#   store_dir/month=2010-12/part-<id>.parquet
+#   store_dir/month=2011-01/part-<id>.parquet
+# read_transaction_store only opens the month folders that overlap the requested window,
+# so a backdated or rolling RFM / CLTV run reads a few months instead of the whole archive.
+
+import json
+import os
+import uuid
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from crm_data import EPOCH
+
+PARTITION_PREFIX = "month="
+
+
+# InvoiceDate as timestamps, also for compact frames where it holds day numbers.
+def _invoice_dates(dataframe):
+    dates = dataframe["InvoiceDate"]
+    if pd.api.types.is_datetime64_any_dtype(dates):
+        return dates
+    return EPOCH + pd.to_timedelta(dates.astype("int64"), unit="D")
+
+
+# Writes the transactions into their month folders.
+# Every call adds a new part file to each month it touches, so daily batches can simply be appended.
+# overwrite=True replaces the existing files of the touched months (e.g. to reload a corrected month).
+# A part is written to a temporary file and renamed when it is complete (like the Parquet cache of crm_data),
+# and with overwrite the old parts are only removed after that, so an interrupted run never leaves a half month.
+def write_transaction_store(dataframe, store_dir, overwrite=False):
+    # grouping on the PeriodArray keeps the month codes as integers (strftime / object arrays are far slower)
+    months = _invoice_dates(dataframe).dt.to_period("M").array
+    for month, part in dataframe.groupby(months, sort=True):
+        partition_dir = os.path.join(store_dir, PARTITION_PREFIX + str(month))
+        os.makedirs(partition_dir, exist_ok=True)
+        old_files = _partition_files(partition_dir) if overwrite else []
+        file_name = os.path.join(partition_dir, f"part-{uuid.uuid4().hex}.parquet")
+        part.to_parquet(file_name + ".tmp", index=False)
+        os.replace(file_name + ".tmp", file_name)
+        for old_file in old_files:
+            os.remove(old_file)
+
+
+# The complete part files of a month folder (temporary files of an interrupted write are skipped).
+def _partition_files(partition_dir):
+    return [os.path.join(partition_dir, name) for name in sorted(os.listdir(partition_dir))
+            if name.endswith(".parquet")]
+
+
+# Months that are stored, oldest first.
+def list_store_months(store_dir):
+    if not os.path.isdir(store_dir):
+        return []
+    return sorted(name[len(PARTITION_PREFIX):] for name in os.listdir(store_dir)
+                  if name.startswith(PARTITION_PREFIX))
+
+
+# Reads the transactions with start <= InvoiceDate < end. start and/or end can be left out.
+# Only the month folders that overlap the window are read; rows of the first and last month
+# are then filtered to the exact window. columns limits the columns read from disk.
+# A window without stored months gives an empty frame with the stored columns and types.
+def read_transaction_store(store_dir, start=None, end=None, columns=None):
+    start = None if start is None else pd.Timestamp(start)
+    end = None if end is None else pd.Timestamp(end)
+
+    files = []
+    months = list_store_months(store_dir)
+    for month in months:
+        month_start = pd.Timestamp(month + "-01")
+        month_end = month_start + pd.offsets.MonthBegin(1)
+        if (start is not None and month_end <= start) or (end is not None and month_start >= end):
+            continue
+        files += _partition_files(os.path.join(store_dir, PARTITION_PREFIX + month))
+
+    if columns is not None and "InvoiceDate" not in columns:
+        columns = list(columns) + ["InvoiceDate"]
+    if not files:
+        return _empty_store_frame(store_dir, months, columns)
+    dataframe = pd.concat([pd.read_parquet(file, columns=columns) for file in files], ignore_index=True)
+
+    dates = _invoice_dates(dataframe)
+    keep = pd.Series(True, index=dataframe.index)
+    if start is not None:
+        keep &= dates >= start
+    if end is not None:
+        keep &= dates < end
+    return dataframe[keep.to_numpy()].reset_index(drop=True)
+
+
+# Zero rows with the schema of the first stored part, read from its Parquet metadata only.
+def _empty_store_frame(store_dir, months, columns):
+    for month in months:
+        for file in _partition_files(os.path.join(store_dir, PARTITION_PREFIX + month)):
+            dataframe = pq.read_schema(file).empty_table().to_pandas()
+            return dataframe if columns is None else dataframe[columns]
+    return pd.DataFrame(columns=columns)
+
+
+####################### #############
+# Segment Snapshot Store
+####################### #############
+
+# Keeps RFM snapshots (see create_rfm_snapshots) as one small file per analysis date:
+#   snapshot_dir/segments.json              segment names, position = integer code
+#   snapshot_dir/date=2011-01-01.parquet    Customer ID (in its own dtype, e.g. the string master_id of FLO)
+#                                           + int8 segment code
+# Only the codes are stored, so a year of monthly snapshots of millions of customers stays a few MB
+# and segment_transitions can compare them without touching strings.
+SNAPSHOT_PREFIX = "date="
+SEGMENTS_FILE = "segments.json"
+
+
+# Writes the segments of every date of snapshots (long frame with Customer ID, date and a categorical segment).
+# A date that is already stored is replaced. All snapshots of a folder must use the same segment names.
+def write_segment_snapshots(snapshots, snapshot_dir, customer_col="Customer ID"):
+    os.makedirs(snapshot_dir, exist_ok=True)
+    categories = list(snapshots["segment"].cat.categories)
+    segments_file = os.path.join(snapshot_dir, SEGMENTS_FILE)
+    if os.path.exists(segments_file):
+        with open(segments_file) as file:
+            stored = json.load(file)
+        if stored != categories:
+            raise ValueError(f"Segments {categories} differ from the stored segments {stored}.")
+    else:
+        with open(segments_file, "w") as file:
+            json.dump(categories, file, indent=2)
+
+    for date, snapshot in snapshots.groupby("date", sort=True):
+        codes = pd.DataFrame({customer_col: snapshot[customer_col].array,
+                              "segment_code": snapshot["segment"].cat.codes.to_numpy(dtype="int8")})
+        file_name = os.path.join(snapshot_dir, f"{SNAPSHOT_PREFIX}{pd.Timestamp(date):%Y-%m-%d}.parquet")
+        tmp_file = file_name + ".tmp"
+        codes.to_parquet(tmp_file, index=False)
+        os.replace(tmp_file, file_name)
+
+
+# Dates that are stored, oldest first.
+def list_snapshot_dates(snapshot_dir):
+    if not os.path.isdir(snapshot_dir):
+        return []
+    return sorted(pd.Timestamp(name[len(SNAPSHOT_PREFIX):-len(".parquet")]) for name in os.listdir(snapshot_dir)
+                  if name.startswith(SNAPSHOT_PREFIX) and name.endswith(".parquet"))
+
+
+# Reads the snapshots with start <= date <= end back into a long frame (Customer ID, date, segment).
+# segment is a categorical built directly from the stored codes.
+def read_segment_snapshots(snapshot_dir, start=None, end=None, customer_col="Customer ID"):
+    with open(os.path.join(snapshot_dir, SEGMENTS_FILE)) as file:
+        categories = json.load(file)
+    frames = []
+    dates = list_snapshot_dates(snapshot_dir)
+    for date in dates:
+        if (start is not None and date < pd.Timestamp(start)) or (end is not None and date > pd.Timestamp(end)):
+            continue
+        codes = pd.read_parquet(os.path.join(snapshot_dir, f"{SNAPSHOT_PREFIX}{date:%Y-%m-%d}.parquet"))
+        frames.append(pd.DataFrame({customer_col: codes[customer_col].array,
+                                    "date": date,
+                                    "segment": pd.Categorical.from_codes(codes["segment_code"], categories)}))
+    if not frames:
+        # the customer ids keep the dtype they were stored with
+        customer_ids = pd.Series(dtype="int64")
+        if dates:
+            schema = pq.read_schema(os.path.join(snapshot_dir, f"{SNAPSHOT_PREFIX}{dates[0]:%Y-%m-%d}.parquet"))
+            customer_ids = schema.empty_table().to_pandas()[customer_col]
+        return pd.DataFrame({customer_col: customer_ids,
+                             "date": pd.Series(dtype="datetime64[ns]"),
+                             "segment": pd.Categorical([], categories)})
+    return pd.concat(frames, ignore_index=True)